@@ -0,0 +1,363 @@
+"""
+Drives the item cog's commands with fake contexts against a local Postgres database, so we can see
+how it behaves under load without connecting to Discord.
+
+Run from the repository root:
+
+    python -m benchmarks.item_economy --config config/config.toml --invocations 2000 --concurrency 200
+    python -m benchmarks.item_economy --compare benchmarks/results/abc1234.json benchmarks/results/def5678.json
+
+The database in the config needs the schema from `config/database.pgsql` loaded. Everything the benchmark
+makes lives in a single guild (`--guild-id`), which is cleared out before and after each run.
+"""
+
+import argparse
+import asyncio
+import datetime as dt
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+import types
+import typing
+
+import discord
+import toml
+import voxelbotutils as utils
+
+from cogs.item_commands import ItemCommands
+
+
+RESULTS_DIRECTORY = os.path.join(os.path.dirname(__file__), "results")
+BENCHMARK_TABLES = (
+    "user_inventories", "item_events", "guild_item_acquire_methods", "craftable_item_ingredients",
+    "craftable_items", "guild_items",
+)
+
+
+class FakeUser(object):
+
+    def __init__(self, user_id:int, *, bot:bool=False):
+        self.id = user_id
+        self.bot = bot
+        self.name = f"user{user_id}"
+        self.display_name = self.name
+        self.discriminator = "0001"
+        self.mention = f"<@{user_id}>"
+        self.avatar_url = ""
+
+    def __str__(self):
+        return f"{self.name}#{self.discriminator}"
+
+
+class FakeMessage(discord.Message):
+    """
+    A message that's never been near Discord. It subclasses the real thing so isinstance checks still work.
+    """
+
+    def __init__(self, content:str=None, *, channel=None, author:FakeUser=None, guild=None, **kwargs):
+        self.id = time.perf_counter_ns()
+        self.content = content
+        self.channel = channel
+        self.author = author
+        self.guild = guild
+        self.embed = kwargs.get('embed')
+        self.file = kwargs.get('file')
+
+    async def add_reaction(self, emoji):
+        pass
+
+    async def edit(self, **kwargs):
+        pass
+
+
+class FakeContext(object):
+    """
+    Stands in for a command context, keeping what the command sent rather than sending it anywhere.
+    """
+
+    def __init__(self, bot:'FakeBot', guild_id:int, user_id:int, command_name:str):
+        self.bot = bot
+        self.guild = types.SimpleNamespace(id=guild_id)
+        self.channel = types.SimpleNamespace(id=user_id)
+        self.author = FakeUser(user_id)
+        self.command = types.SimpleNamespace(qualified_name=command_name)
+        self.clean_prefix = "i."
+        self.message = FakeMessage(command_name, channel=self.channel, author=self.author, guild=self.guild)
+        self.sent: typing.List[FakeMessage] = []
+
+    async def send(self, content:str=None, **kwargs):
+        message = FakeMessage(content, channel=self.channel, author=self.bot.user, guild=self.guild, **kwargs)
+        self.sent.append(message)
+        return message
+
+    def typing(self):
+        return FakeTyping()
+
+
+class FakeTyping(object):
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class FakeBot(object):
+    """
+    Enough of a bot for the item cog to be made and run. Anything the cog waits for is answered
+    straight away - messages with `message_reply` and reactions with a tick.
+    """
+
+    def __init__(self, config:dict, *, message_reply:str="1"):
+        self.config = config
+        self.logger = logging.getLogger("bot")
+        self.database = utils.DatabaseConnection
+        self.database.logger = self.logger.getChild("database")
+        self.redis = utils.RedisConnection
+        self.loop = asyncio.get_event_loop()
+        self.user = FakeUser(1, bot=True)
+        self.message_reply = message_reply
+
+    async def wait_for(self, event:str, *, check=None, timeout:float=None):
+        if event == "message":
+            return FakeMessage(self.message_reply)
+        if event == "reaction_add":
+            return types.SimpleNamespace(emoji="\N{HEAVY CHECK MARK}"), None
+        raise asyncio.TimeoutError()
+
+    async def wait_until_ready(self):
+        await asyncio.Event().wait()
+
+    async def close(self):
+        pass
+
+
+def percentile(values:typing.List[float], percent:float) -> float:
+    """
+    Gets a percentile from a sorted list using the nearest-rank method.
+    """
+
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, int(round(percent / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def get_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def set_up_guild(guild_id:int, *, cooldown:float) -> None:
+    """
+    Gives the benchmark guild a gettable item and a recipe that's crafted from it.
+    """
+
+    async with utils.DatabaseConnection() as db:
+        await db("INSERT INTO guild_items (guild_id, item_name) VALUES ($1, 'wood'), ($1, 'plank')", guild_id)
+        await db(
+            """INSERT INTO guild_item_acquire_methods (guild_id, item_name, acquired_by, min_acquired, max_acquired, acquire_per)
+            VALUES ($1, 'wood', 'Command', 5, 5, $2)""",
+            guild_id, cooldown,
+        )
+        await db("INSERT INTO craftable_items (guild_id, item_name, amount_created) VALUES ($1, 'plank', 4)", guild_id)
+        await db(
+            "INSERT INTO craftable_item_ingredients (guild_id, item_name, ingredient_name, amount) VALUES ($1, 'plank', 'wood', 1)",
+            guild_id,
+        )
+
+
+async def clear_guild(guild_id:int) -> None:
+    async with utils.DatabaseConnection() as db:
+        for table in BENCHMARK_TABLES:
+            await db(f"DELETE FROM {table} WHERE guild_id=$1", guild_id)
+        await db("DELETE FROM item_cooldowns WHERE cooldown_key LIKE $1", f"%:{guild_id}:%:%")
+
+
+async def run_command(cog:ItemCommands, bot:FakeBot, command_name:str, guild_id:int, user_id:int, kwargs:dict) -> float:
+    """
+    Runs a single command the same way the bot would, returning how long it took.
+    """
+
+    ctx = FakeContext(bot, guild_id, user_id, command_name)
+    start_time = time.perf_counter()
+    await cog.cog_before_invoke(ctx)
+    await getattr(ItemCommands, command_name).callback(cog, ctx, **kwargs)
+    await cog.cog_after_invoke(ctx)
+    return time.perf_counter() - start_time
+
+
+async def benchmark_command(
+        cog:ItemCommands, bot:FakeBot, command_name:str, kwargs:dict, *, guild_id:int, users:int,
+        invocations:int, concurrency:int) -> dict:
+    """
+    Runs a command a number of times, spread over the given number of users, with at most `concurrency`
+    of them running at once.
+    """
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def run_one(index):
+        nonlocal errors
+        async with semaphore:
+            try:
+                latencies.append(await run_command(cog, bot, command_name, guild_id, 1_000 + (index % users), kwargs))
+            except Exception as e:
+                errors += 1
+                bot.logger.error(f"{command_name} failed - {e!r}")
+
+    # Run the command, watching how many round trips the cog made to the database - including the BEGIN and
+    # COMMIT of any transactions, which the data layer counts as queries
+    start_queries = cog.database.query_count
+    start_acquires = cog.database.acquire_count
+    start_time = time.perf_counter()
+    await asyncio.gather(*[run_one(i) for i in range(invocations)])
+    total_time = time.perf_counter() - start_time
+    queries = cog.database.query_count - start_queries
+    acquires = cog.database.acquire_count - start_acquires
+
+    # Work out the stats
+    latencies.sort()
+    return {
+        "invocations": invocations,
+        "errors": errors,
+        "total_time": total_time,
+        "throughput": invocations / total_time if total_time else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": latencies[-1] if latencies else 0.0,
+        "queries_per_command": queries / invocations,
+        "acquires_per_command": acquires / invocations,
+    }
+
+
+async def run_benchmark(args:argparse.Namespace) -> dict:
+    """
+    Sets up the cog and the benchmark guild, then runs each command in turn.
+    """
+
+    with open(args.config) as a:
+        config = toml.load(a)
+    config.setdefault('inventory_write_behind', {})['enabled'] = args.write_behind
+    config.setdefault('item_cooldowns', {})['backend'] = args.cooldown_backend
+    config.pop('metrics', None)
+    config['rate_limits'] = {'commands': {}}
+    await utils.DatabaseConnection.create_pool(config['database'])
+    bot = FakeBot(config)
+    cog = ItemCommands(bot)
+
+    # Run the commands
+    await clear_guild(args.guild_id)
+    await set_up_guild(args.guild_id, cooldown=args.cooldown)
+    commands_to_run = [
+        ("getitem", {"item_name": "wood"}),
+        ("craftitem", {"crafted_item_name": "plank"}),
+        ("inventory", {}),
+    ]
+    results = {}
+    try:
+        for command_name, kwargs in commands_to_run:
+            if args.commands and command_name not in args.commands:
+                continue
+            results[command_name] = await benchmark_command(
+                cog, bot, command_name, kwargs, guild_id=args.guild_id, users=args.users,
+                invocations=args.invocations, concurrency=args.concurrency,
+            )
+            await cog.inventory_buffer.flush()
+    finally:
+        cog.cog_unload()
+        await cog.unload_task
+        await clear_guild(args.guild_id)
+        await utils.DatabaseConnection.pool.close()
+
+    return {
+        "commit": get_commit(),
+        "timestamp": dt.datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "settings": {
+            "invocations": args.invocations,
+            "concurrency": args.concurrency,
+            "users": args.users,
+            "cooldown": args.cooldown,
+            "cooldown_backend": args.cooldown_backend,
+            "write_behind": args.write_behind,
+        },
+        "commands": results,
+    }
+
+
+def print_results(results:dict) -> None:
+    print(f"Commit {results['commit']} - {results['settings']}")
+    print(f"{'command':<12}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'queries':>10}{'errors':>8}")
+    for command_name, stats in results['commands'].items():
+        print(
+            f"{command_name:<12}{stats['throughput']:>10.1f}{stats['latency_p50'] * 1000:>10.2f}"
+            f"{stats['latency_p99'] * 1000:>10.2f}{stats['latency_max'] * 1000:>10.2f}"
+            f"{stats['queries_per_command']:>10.2f}{stats['errors']:>8}"
+        )
+
+
+def print_comparison(before:dict, after:dict) -> None:
+    """
+    Shows how each command changed between two saved runs.
+    """
+
+    print(f"{before['commit']} -> {after['commit']}")
+    if before['settings'] != after['settings']:
+        print(f"Warning: the runs used different settings ({before['settings']} vs {after['settings']})")
+    print(f"{'command':<12}{'stat':<22}{'before':>12}{'after':>12}{'change':>10}")
+    for command_name, after_stats in after['commands'].items():
+        before_stats = before['commands'].get(command_name)
+        if before_stats is None:
+            continue
+        for stat in ("throughput", "latency_p50", "latency_p99", "queries_per_command"):
+            old, new = before_stats[stat], after_stats[stat]
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"{command_name:<12}{stat:<22}{old:>12.4f}{new:>12.4f}{change:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the item cog's commands against a local database.")
+    parser.add_argument("--config", default="config/config.toml", help="The bot config to read the database settings from.")
+    parser.add_argument("--invocations", type=int, default=1000, help="How many times to run each command.")
+    parser.add_argument("--concurrency", type=int, default=100, help="How many commands can run at once.")
+    parser.add_argument("--users", type=int, default=500, help="How many different users the commands are spread over.")
+    parser.add_argument("--guild-id", type=int, default=1, help="The guild to run the benchmark in; its data is deleted.")
+    parser.add_argument("--cooldown", type=float, default=0.0, help="The getitem cooldown, in seconds.")
+    parser.add_argument("--cooldown-backend", default="database", choices=["memory", "database", "redis"])
+    parser.add_argument("--write-behind", action="store_true", help="Buffer getitem rewards in memory.")
+    parser.add_argument("--commands", nargs="*", help="Only run these commands.")
+    parser.add_argument("--output", help="Where to save the results - defaults to benchmarks/results/<commit>.json.")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two saved results instead of running.")
+    args = parser.parse_args()
+
+    # See if we're just comparing
+    if args.compare:
+        with open(args.compare[0]) as a:
+            before = json.load(a)
+        with open(args.compare[1]) as a:
+            after = json.load(a)
+        return print_comparison(before, after)
+
+    # Run and save
+    logging.basicConfig(level=logging.WARNING)
+    results = asyncio.get_event_loop().run_until_complete(run_benchmark(args))
+    print_results(results)
+    output = args.output or os.path.join(RESULTS_DIRECTORY, f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as a:
+        json.dump(results, a, indent=4)
+    print(f"Saved results to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,267 @@
 import asyncio
+import concurrent.futures
+import datetime as dt
+import io
+import os
+import time
 import typing
 import random
-import collections
-from datetime import datetime as dt, timedelta
 
 import asyncpg
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 import voxelbotutils as utils
 
+from cogs import utils as localutils
+
 
 class ItemCommands(utils.Cog):
 
     def __init__(self, bot:utils.Bot):
         super().__init__(bot)
-        self.last_command_run = collections.defaultdict(lambda: dt(2000, 1, 1))
+        database_config = self.bot.config.get('item_database', {})
+        self.database = localutils.ItemDatabase(
+            self.bot.database,
+            query_timeout=database_config.get('query_timeout', 10.0),
+            acquire_timeout=database_config.get('acquire_timeout', 10.0),
+            leak_threshold=database_config.get('leak_threshold', 30.0),
+            logger=self.logger.getChild('database'),
+        )
+        self.item_cache = localutils.GuildItemCache(
+            self.database,
+            max_size=self.bot.config.get('item_cache', {}).get('max_guilds', 1000),
+        )
+        self.message_acquire_methods = localutils.MessageAcquireIndex(self.database)
+        self.getitem_cooldowns = localutils.get_cooldown_store(self.bot, self.database, 'getitem')
+        self.rate_limiter = localutils.get_command_rate_limiter(self.bot)
+        self.message_cooldowns = localutils.MemoryCooldownStore(
+            'message',
+            max_size=self.bot.config.get('item_cooldowns', {}).get('max_size', 100_000),
+        )
+        write_behind_config = self.bot.config.get('inventory_write_behind', {})
+        self.write_behind_enabled = write_behind_config.get('enabled', False)
+        self.inventory_buffer = localutils.InventoryWriteBuffer(
+            self.database,
+            flush_interval=write_behind_config.get('flush_interval', 2.0),
+            max_pending=write_behind_config.get('max_pending', 10_000),
+            logger=self.logger.getChild('inventory_buffer'),
+        )
+        self.inventory_buffer.start()
+        item_events_config = self.bot.config.get('item_events', {})
+        self.item_events = localutils.ItemEventLog(
+            self.database,
+            enabled=item_events_config.get('enabled', True),
+            flush_interval=item_events_config.get('flush_interval', 5.0),
+            max_pending=item_events_config.get('max_pending', 10_000),
+            logger=self.logger.getChild('item_events'),
+        )
+        self.item_events.start()
+        item_map_config = self.bot.config.get('item_map', {})
+        self.item_map_renderer = localutils.ItemMapRenderer(
+            layout=item_map_config.get('graphviz_layout', 'neato'),
+            max_concurrent=item_map_config.get('max_concurrent_renders', 2),
+            timeout=item_map_config.get('render_timeout', 10.0),
+            workers=item_map_config.get('render_workers', 0),
+        )
+        self.item_map_cache = localutils.RenderCache(
+            max_bytes=item_map_config.get('cache_max_bytes', 32 * 1024 * 1024),
+            directory=item_map_config.get('cache_directory') or None,
+            disk_max_bytes=item_map_config.get('cache_directory_max_bytes', 256 * 1024 * 1024),
+            disk_max_age=item_map_config.get('cache_directory_max_age', 7 * 24 * 60 * 60),
+        )
+        metrics_config = self.bot.config.get('metrics', {})
+        self.metrics = localutils.ItemMetrics(self.database)
+        self.metrics_exporter = None
+        if metrics_config.get('enabled', False):
+            self.metrics_exporter = localutils.MetricsExporter(
+                self.metrics,
+                host=metrics_config.get('host', '127.0.0.1'),
+                port=metrics_config.get('port') or None,
+                file=metrics_config.get('file') or None,
+                file_interval=metrics_config.get('file_interval', 60.0),
+                logger=self.logger.getChild('metrics'),
+            )
+            self.bot.loop.create_task(self.metrics_exporter.start())
+        self.cache_invalidator = localutils.get_cache_invalidator(self.bot, self.database, self.logger.getChild('cache_invalidation'))
+        self.cache_invalidator.add_callback(self.drop_cached_guild_data)
+        self.bot.loop.create_task(self.cache_invalidator.start())
+        self.shop_index = localutils.ShopIndex()
+        self.setup_sessions = localutils.SetupSessionStore(
+            self.database,
+            timeout=self.bot.config.get('setup_sessions', {}).get('timeout', 120.0),
+        )
+        self.expire_setup_sessions.start()
+        self.refresh_wealth_leaderboard.change_interval(seconds=self.bot.config.get('leaderboards', {}).get('refresh_interval', 300))
+        self.refresh_wealth_leaderboard.start()
+        self.unload_task: asyncio.Task = None
+
+    def cog_unload(self):
+        self.refresh_wealth_leaderboard.cancel()
+        self.expire_setup_sessions.cancel()
+        self.unload_task = self.bot.loop.create_task(self.shutdown())
+
+    async def shutdown(self):
+        """
+        Writes everything that's still buffered, then stops the cog's background work.
+        """
+
+        await self.flush_buffers()
+        self.item_map_renderer.close()
+        await self.cache_invalidator.stop()
+        if self.metrics_exporter is not None:
+            await self.metrics_exporter.stop()
+
+    async def flush_buffers(self):
+        """
+        Stops the inventory write buffer and item event log, writing everything they're holding.
+        """
+
+        for name, buffer in (('inventory buffer', self.inventory_buffer), ('item event log', self.item_events)):
+            try:
+                await buffer.close()
+            except Exception as e:
+                self.logger.error(f"Failed to write the {name} while closing - {e}")
+
+    @utils.Cog.listener()
+    async def on_disconnect(self):
+        """
+        Writes everything that's still buffered once the bot's been closed. Cogs aren't unloaded when the bot
+        shuts down, but closing it does dispatch a disconnect, and the database pool waits for connections to
+        be given back before it closes.
+        """
+
+        if self.bot.is_closed():
+            await self.flush_buffers()
+
+    async def cache_setup(self, db:utils.DatabaseConnection):
+        """
+        Loads the message acquire methods, shop messages, and unfinished setup sessions for this process' shards
+        into memory so that messages and reactions can be matched against them.
+        """
+
+        shard_count, shard_ids = self.get_shard_filter()
+        await self.message_acquire_methods.reload(shard_count=shard_count, shard_ids=shard_ids)
+        self.logger.info(f"Loaded message acquire methods for {len(self.message_acquire_methods):,} guilds")
+        self.shop_index.load(await db(
+            "SELECT * FROM guild_item_shop_messages WHERE $1::INTEGER IS NULL OR (guild_id >> 22) % $1 = ANY($2::INTEGER[])",
+            shard_count, shard_ids,
+        ))
+        self.logger.info(f"Loaded {len(self.shop_index):,} shop messages")
+        self.setup_sessions.load(await db(
+            "SELECT * FROM item_setup_sessions WHERE $1::INTEGER IS NULL OR (guild_id >> 22) % $1 = ANY($2::INTEGER[])",
+            shard_count, shard_ids,
+        ))
+        self.logger.info(f"Loaded {len(self.setup_sessions):,} setup sessions")
+
+    async def cog_before_invoke(self, ctx:utils.Context):
+        """
+        Checks the command's rate limits, then starts timing it, counting the time spent sending messages
+        as Discord API time. This runs before the command does any database or render work.
+        """
+
+        try:
+            self.rate_limiter.try_acquire(ctx.command.qualified_name, ctx.guild.id if ctx.guild else None, ctx.author.id)
+        except localutils.CommandRateLimited as e:
+            self.metrics.cooldown_hits.inc(source=f'rate_limit_{e.scope}')
+            raise
+        ctx.command_timer = localutils.CommandTimer()
+        localutils.current_command_timer.set(ctx.command_timer)
+        ctx.send = localutils.timed_coroutine_function('discord', ctx.send)
+
+    async def cog_after_invoke(self, ctx:utils.Context):
+        """
+        Records how long the command took and where the time went.
+        """
+
+        timer = getattr(ctx, 'command_timer', None)
+        if timer is None:
+            return
+        command_name = ctx.command.qualified_name
+        self.metrics.command_seconds.observe(timer.elapsed, command=command_name, phase='total')
+        for phase in ('database', 'discord', 'render'):
+            self.metrics.command_seconds.observe(timer.phases.get(phase, 0.0), command=command_name, phase=phase)
+
+    @tasks.loop(minutes=5)
+    async def refresh_wealth_leaderboard(self):
+        """
+        Rebuilds the materialized view that the guild-wide leaderboard is read from. The view covers every
+        guild, so only the process running the first shard rebuilds it, and an advisory lock makes sure two
+        processes never do at once (eg while that process is being restarted).
+        """
+
+        shard_count, shard_ids = self.get_shard_filter()
+        if shard_count is not None and 0 not in shard_ids:
+            return
+        try:
+            async with self.database() as db:
+                async with db.transaction():
+                    rows = await db("SELECT pg_try_advisory_xact_lock(hashtext('guild_user_wealth')) AS locked")
+                    if not rows[0]['locked']:
+                        return
+                    await db(
+                        "REFRESH MATERIALIZED VIEW CONCURRENTLY guild_user_wealth",
+                        timeout=self.bot.config.get('leaderboards', {}).get('refresh_timeout', 600.0),
+                    )
+        except Exception as e:
+            self.logger.error(f"Failed to refresh the wealth leaderboard - {e}")
+
+    @refresh_wealth_leaderboard.before_loop
+    async def before_refresh_wealth_leaderboard(self):
+        await self.bot.wait_until_ready()
+
+    def get_shard_filter(self) -> typing.Tuple[typing.Optional[int], typing.List[int]]:
+        """
+        Gets the shard count and the IDs of the shards that this process runs, or None for the count if
+        the bot isn't sharded and every guild is ours.
+        """
+
+        shard_count = getattr(self.bot, 'shard_count', None)
+        shard_ids = getattr(self.bot, 'shard_ids', None)
+        if not shard_count or shard_count <= 1 or shard_ids is None:
+            return None, []
+        return shard_count, list(shard_ids)
+
+    def invalidate_guild_data(self, guild_id:int) -> None:
+        """
+        Drops everything cached for a guild after its items, acquire methods, or recipes change, and tells
+        any other processes running the bot to do the same.
+        """
+
+        self.drop_cached_guild_data(guild_id)
+        self.bot.loop.create_task(self.cache_invalidator.publish(guild_id))
+
+    def drop_cached_guild_data(self, guild_id:typing.Optional[int]) -> None:
+        """
+        Drops everything cached for a guild in this process, or for every guild if the ID is None.
+        """
+
+        if guild_id is None:
+            self.item_cache.clear()
+            self.bot.loop.create_task(self.reload_message_acquire_methods(None))
+            return
+        self.item_cache.invalidate(guild_id)
+        self.item_map_cache.invalidate_guild(guild_id)
+        if self.is_our_guild(guild_id):
+            self.bot.loop.create_task(self.reload_message_acquire_methods(guild_id))
+
+    async def reload_message_acquire_methods(self, guild_id:typing.Optional[int]) -> None:
+        """
+        Reloads the message acquire methods for a guild, or for every guild on this process' shards.
+        """
+
+        shard_count, shard_ids = self.get_shard_filter()
+        try:
+            await self.message_acquire_methods.reload(guild_id, shard_count=shard_count, shard_ids=shard_ids)
+        except Exception as e:
+            self.logger.error(f"Failed to reload message acquire methods for guild {guild_id} - {e}")
+
+    def is_our_guild(self, guild_id:int) -> bool:
+        """
+        Gets whether a guild is on one of the shards that this process runs.
+        """
+
+        shard_count, shard_ids = self.get_shard_filter()
+        return shard_count is None or (guild_id >> 22) % shard_count in shard_ids
 
     @staticmethod
     def get_reaction_add_check(ctx:utils.Context, message:discord.Message, valid_reactions:typing.List[str]):
@@ -29,23 +276,54 @@ class ItemCommands(utils.Cog):
     @commands.guild_only()
     async def inventory(self, ctx:utils.Context, user:discord.Member=None):
         """
-        Checks the inventory of a user.of
+        Checks the inventory of a user.
         """
 
-        # Get items for the user
+        # Get the first page of items for the user - writing anything that's still buffered first so it shows up
         user = user or ctx.author
-        async with self.bot.database() as db:
-            items = await db("SELECT item_name, amount FROM user_inventories WHERE guild_id=$1 AND user_id=$2", ctx.guild.id, user.id)
-        if not items:
+        per_page = 20
+        await self.inventory_buffer.flush(ctx.guild.id, user.id)
+        first_page = await self.get_inventory_page(ctx.guild.id, user.id, per_page)
+        if not first_page:
             return await ctx.send(f"**{user!s}** has no items :c")
 
         # Make embed
-        with utils.Embed() as embed:
-            embed.description = '\n'.join([
-                f"{i['amount']:,}x {i['item_name']}" for i in items if i['amount'] > 0
-            ])
-            embed.set_author_to_user(user)
-        return await ctx.send(embed=embed)
+        def formatter(menu, items):
+            with utils.Embed() as embed:
+                embed.description = '\n'.join([f"{i['amount']:,}x {i['item_name']}" for i in items])
+                embed.set_author_to_user(user)
+                if menu is not None:
+                    embed.set_footer(f"Page {menu.current_page + 1}")
+            return embed
+
+        # See if it all fits on one page
+        if len(first_page) < per_page:
+            return await ctx.send(embed=formatter(None, first_page))
+
+        # Only fetch more pages as they're turned to
+        async def get_pages():
+            page = first_page
+            while page:
+                yield page
+                if len(page) < per_page:
+                    return
+                page = await self.get_inventory_page(ctx.guild.id, user.id, per_page, after=page[-1]['item_name'])
+
+        # The paginator spends most of its time waiting for reactions, so it's left out of the command's timing
+        with localutils.untimed():
+            return await utils.Paginator(get_pages(), per_page=per_page, formatter=formatter).start(ctx)
+
+    async def get_inventory_page(self, guild_id:int, user_id:int, per_page:int, *, after:str=None) -> typing.List[dict]:
+        """
+        Gets a page of a user's inventory, sorted by item name, starting after the given item name.
+        """
+
+        async with self.database() as db:
+            return await db(
+                """SELECT item_name, amount FROM user_inventories WHERE guild_id=$1 AND user_id=$2 AND amount > 0
+                AND ($3::TEXT IS NULL OR item_name > $3::TEXT) ORDER BY item_name LIMIT $4""",
+                guild_id, user_id, after, per_page,
+            )
 
     @utils.command(aliases=['craft'])
     @commands.guild_only()
@@ -56,17 +334,20 @@ class ItemCommands(utils.Cog):
 
         # See if there's a crafting recipe set up
         crafted_item_name = crafted_item_name.lower()
-        async with self.bot.database() as db:
-            item_craft_amount = await db("SELECT * FROM craftable_items WHERE guild_id=$1 AND item_name=$2", ctx.guild.id, crafted_item_name)
-            if not item_craft_amount:
-                return await ctx.send(f"You can't acquire **{crafted_item_name}** items via the crafting.")
-            item_craft_ingredients = await db("SELECT * FROM craftable_item_ingredients WHERE guild_id=$1 AND item_name=$2", ctx.guild.id, crafted_item_name)
-            user_inventory = await db("SELECT * FROM user_inventories WHERE guild_id=$1 AND user_id=$2", ctx.guild.id, ctx.author.id)
+        catalog = await self.item_cache.get(ctx.guild.id)
+        amount_created = catalog.craftable_items.get(crafted_item_name)
+        if amount_created is None:
+            return await ctx.send(f"You can't acquire **{crafted_item_name}** items via the crafting.")
+        ingredients = catalog.recipes.get(crafted_item_name, {})
+        await self.inventory_buffer.flush(ctx.guild.id, ctx.author.id)
+        async with self.database() as db:
+            user_inventory = await db(
+                "SELECT item_name, amount FROM user_inventories WHERE guild_id=$1 AND user_id=$2 AND item_name=ANY($3::TEXT[])",
+                ctx.guild.id, ctx.author.id, list(ingredients),
+            )
 
         # Add in some dictionaries to make this a lil easier
-        ingredients = {i['ingredient_name']: i['amount'] for i in item_craft_ingredients}
-        inventory_original = {i['item_name']: i['amount'] for i in user_inventory if i['item_name'] in ingredients}
-        inventory = inventory_original.copy()
+        inventory = {i['item_name']: i['amount'] for i in user_inventory}
 
         # See if they have enough of the items
         max_craftable_amount = []
@@ -78,12 +359,13 @@ class ItemCommands(utils.Cog):
 
         # Make sure they wanna make it
         ingredient_string = [f"`{o}x {i}`" for i, o in ingredients.items()]
-        await ctx.send(f"This craft gives you **{item_craft_amount[0]['amount_created']}x {crafted_item_name}** and is made from {', '.join(ingredient_string)}. You can make this between 0 and {max_craftable_amount} times - how many times would you like to craft this?")
+        await ctx.send(f"This craft gives you **{amount_created}x {crafted_item_name}** and is made from {', '.join(ingredient_string)}. You can make this between 0 and {max_craftable_amount} times - how many times would you like to craft this?")
         try:
-            crafting_amount_message = await self.bot.wait_for(
-                "message", timeout=120.0,
-                check=lambda m: m.channel.id == ctx.channel.id and m.author.id == ctx.author.id and m.content
-            )
+            with localutils.untimed():
+                crafting_amount_message = await self.bot.wait_for(
+                    "message", timeout=120.0,
+                    check=lambda m: m.channel.id == ctx.channel.id and m.author.id == ctx.author.id and m.content
+                )
         except asyncio.TimeoutError:
             return await ctx.send("Timed out on crafting confirmation - please try again later.")
 
@@ -98,27 +380,163 @@ class ItemCommands(utils.Cog):
         if user_craft_amount <= 0:
             return await ctx.send("Alright, aborting crafting!")
 
-        # Remove the right amounts from their inventory
+        # Make sure they asked for an amount they could make (the database checks this again when crafting)
         for ingredient, required_amount in ingredients.items():
             if inventory[ingredient] - (required_amount * user_craft_amount) < 0:
                 return await ctx.send(f"You don't have enough **{ingredient}** items to craft this.")
-            inventory[ingredient] -= (required_amount * user_craft_amount)
 
         # Alter their inventory babey lets GO
         async with ctx.typing():
-            async with self.bot.database() as db:
-                for item, amount in inventory.items():
-                    await db(
-                        "UPDATE user_inventories SET amount=$4 WHERE guild_id=$1 AND user_id=$2 AND item_name=$3",
-                        ctx.guild.id, ctx.author.id, item, amount
-                    )
-                await db(
-                    """INSERT INTO user_inventories (guild_id, user_id, item_name, amount)
-                    VALUES ($1, $2, $3, $4) ON CONFLICT (guild_id, user_id, item_name)
-                    DO UPDATE SET amount=user_inventories.amount+excluded.amount""",
-                    ctx.guild.id, ctx.author.id, crafted_item_name, item_craft_amount[0]['amount_created'] * user_craft_amount
+            crafted = await self.craft_items(
+                ctx.guild.id, ctx.author.id,
+                {ingredient: required_amount * user_craft_amount for ingredient, required_amount in ingredients.items()},
+                {crafted_item_name: amount_created * user_craft_amount},
+            )
+        if not crafted:
+            return await ctx.send("You don't have enough items to craft this any more - please try again later.")
+        self.metrics.items_crafted.inc(amount_created * user_craft_amount)
+        return await ctx.send(f"You've sucessfully crafted **{amount_created * user_craft_amount:,}x {crafted_item_name}**.")
+
+    async def craft_items(self, guild_id:int, user_id:int, removed_items:typing.Dict[str, int], added_items:typing.Dict[str, int]) -> bool:
+        """
+        Takes the given ingredients out of a user's inventory and gives them the crafted items in one transaction.
+        If they're short on anything then nothing is changed and False is returned.
+        """
+
+        changes = {(user_id, i): -o for i, o in removed_items.items()}
+        for item_name, amount in added_items.items():
+            changes[(user_id, item_name)] = changes.get((user_id, item_name), 0) + amount
+        if not await self.transfer_items(guild_id, changes):
+            return False
+        self.item_events.add_changes(guild_id, changes, 'craft')
+        return True
+
+    async def transfer_items(self, guild_id:int, changes:typing.Dict[typing.Tuple[int, str], int]) -> bool:
+        """
+        Changes any number of inventory rows in one transaction, writing anything that's still buffered for
+        the users involved first. Returns False (and changes nothing) if anyone would end up with less than zero of an item.
+        """
+
+        for user_id in sorted({i[0] for i in changes}):
+            await self.inventory_buffer.flush(guild_id, user_id)
+        async with self.database() as db:
+            return await localutils.apply_inventory_changes(db, guild_id, changes)
+
+    @staticmethod
+    def parse_item_amounts(text:str) -> typing.Dict[str, int]:
+        """
+        Parses a list of items like `5 wood, 2 iron axe, stone` into a dict of item name to amount. Items without a
+        number are counted once.
+
+        Raises:
+            ValueError: If one of the amounts is 0.
+        """
+
+        items = {}
+        for part in text.split(','):
+            part = part.strip().lower()
+            if not part:
+                continue
+            amount_str, _, item_name = part.partition(' ')
+            if amount_str.isdigit() and item_name.strip():
+                amount, item_name = int(amount_str), item_name.strip()
+            else:
+                amount, item_name = 1, part
+            if amount <= 0:
+                raise ValueError(f"You need to give at least one **{item_name}**.")
+            items[item_name] = items.get(item_name, 0) + amount
+        return items
+
+    async def get_crafting_plan(self, ctx:utils.Context, craft_count:int, item_name:str) -> typing.Optional[localutils.CraftingPlan]:
+        """
+        Plans crafting an item from the author's current inventory, telling them if that can't be done.
+        """
+
+        catalog = await self.item_cache.get(ctx.guild.id)
+        recipe_graph = catalog.recipe_graph
+        if item_name not in catalog.craftable_items:
+            await ctx.send(f"You can't acquire **{item_name}** items via the crafting.")
+            return None
+        if item_name in recipe_graph.cyclic_items:
+            await ctx.send(f"The recipe for **{item_name}** loops back on itself, so I can't plan crafting it.")
+            return None
+        await self.inventory_buffer.flush(ctx.guild.id, ctx.author.id)
+        async with self.database() as db:
+            user_inventory = await db(
+                "SELECT item_name, amount FROM user_inventories WHERE guild_id=$1 AND user_id=$2 AND item_name=ANY($3::TEXT[])",
+                ctx.guild.id, ctx.author.id, recipe_graph.topological_order,
+            )
+        plan = recipe_graph.plan(item_name, craft_count, {i['item_name']: i['amount'] for i in user_inventory})
+        if not plan.possible:
+            missing_string = [f"`{o:,}x {i}`" for i, o in plan.missing.items()]
+            await ctx.send(f"You'd need another {', '.join(missing_string)} to craft **{item_name}** {craft_count:,} times.")
+            return None
+        return plan
+
+    @staticmethod
+    def get_crafting_plan_string(plan:localutils.CraftingPlan) -> str:
+        """
+        Gets a human readable version of a crafting plan.
+        """
+
+        steps = '\n'.join([f"{index}. Craft **{item_name}** {crafts:,} times" for index, (item_name, crafts) in enumerate(plan.steps, start=1)])
+        removed = ', '.join([f"`{o:,}x {i}`" for i, o in plan.removed.items()]) or "nothing"
+        added = ', '.join([f"`{o:,}x {i}`" for i, o in plan.added.items()])
+        return f"{steps}\nThis uses {removed} from your inventory and gives you {added}."
+
+    @utils.command(aliases=['plancraft'])
+    @commands.guild_only()
+    async def craftplan(self, ctx:utils.Context, craft_count:typing.Optional[int]=1, *, item_name:commands.clean_content):
+        """
+        Shows the crafts you'd need to make an item from your current inventory.
+        """
+
+        item_name = item_name.lower()
+        if craft_count <= 0:
+            return await ctx.send("You need to craft an item at least once.")
+        plan = await self.get_crafting_plan(ctx, craft_count, item_name)
+        if plan is None:
+            return
+        return await ctx.send(self.get_crafting_plan_string(plan))
+
+    @utils.command(aliases=['craftchain'])
+    @commands.bot_has_permissions(add_reactions=True, send_messages=True)
+    @commands.guild_only()
+    async def craftall(self, ctx:utils.Context, craft_count:typing.Optional[int]=1, *, item_name:commands.clean_content):
+        """
+        Crafts an item along with every intermediate item you need for it.
+        """
+
+        # Work out what they need to do
+        item_name = item_name.lower()
+        if craft_count <= 0:
+            return await ctx.send("You need to craft an item at least once.")
+        plan = await self.get_crafting_plan(ctx, craft_count, item_name)
+        if plan is None:
+            return
+
+        # Make sure they wanna do it
+        valid_reactions = ["\N{HEAVY CHECK MARK}", "\N{HEAVY MULTIPLICATION X}"]
+        confirm_message = await ctx.send(f"{self.get_crafting_plan_string(plan)}\nWould you like to do this?")
+        await asyncio.gather(*[confirm_message.add_reaction(e) for e in valid_reactions])
+        try:
+            with localutils.untimed():
+                reaction, _ = await self.bot.wait_for(
+                    "reaction_add", timeout=120.0,
+                    check=self.get_reaction_add_check(ctx, confirm_message, valid_reactions),
                 )
-        return await ctx.send(f"You've sucessfully crafted **{item_craft_amount[0]['amount_created'] * user_craft_amount:,}x {crafted_item_name}**.")
+        except asyncio.TimeoutError:
+            return await ctx.send("Timed out on crafting confirmation - please try again later.")
+        if str(reaction.emoji) == "\N{HEAVY MULTIPLICATION X}":
+            return await ctx.send("Alright, aborting crafting!")
+
+        # Do every craft at once
+        async with ctx.typing():
+            crafted = await self.craft_items(ctx.guild.id, ctx.author.id, plan.removed, plan.added)
+        if not crafted:
+            return await ctx.send("You don't have enough items to craft this any more - please try again later.")
+        self.metrics.items_crafted.inc(sum(plan.added.values()))
+        return await ctx.send(f"You've sucessfully crafted **{plan.added[item_name]:,}x {item_name}**.")
 
     @utils.command()
     @commands.guild_only()
@@ -129,36 +547,320 @@ class ItemCommands(utils.Cog):
 
         # Get the item from the db
         item_name = item_name.lower()
-        db = await self.bot.database.get_connection()
-        acquire_information = await db(
-            "SELECT * FROM guild_item_acquire_methods WHERE guild_id=$1 AND item_name=$2 AND acquired_by='Command'",
-            ctx.guild.id, item_name
-        )
-        if not acquire_information:
-            await db.disconnect()
+        catalog = await self.item_cache.get(ctx.guild.id)
+        acquire_information = catalog.acquire_methods.get((item_name, 'Command'))
+        if acquire_information is None:
             return await ctx.send(f"You can't acquire **{item_name}** items via the `getitem` command.")
-        acquire_information = acquire_information[0]
 
         # See if they hit the timeout
-        last_run = self.last_command_run[(ctx.guild.id, ctx.author.id, item_name)]
-        if last_run + timedelta(seconds=acquire_information['acquire_per']) > dt.utcnow():
-            cooldown_seconds = ((last_run + timedelta(seconds=acquire_information['acquire_per'])) - dt.utcnow()).total_seconds()
+        cooldown_seconds = await self.getitem_cooldowns.try_acquire(
+            (ctx.guild.id, ctx.author.id, item_name), acquire_information['acquire_per'],
+        )
+        if cooldown_seconds:
+            self.metrics.cooldown_hits.inc(source='getitem')
             cooldown_timevalue = utils.TimeValue(cooldown_seconds)
-            await db.disconnect()
             return await ctx.send(f"You can't run this command again for another `{cooldown_timevalue.clean_spaced}`.")
-        self.last_command_run[(ctx.guild.id, ctx.author.id, item_name)] = dt.utcnow()
 
         # Add to database
         amount = random.randint(acquire_information['min_acquired'], acquire_information['max_acquired'])
-        await db(
-            """INSERT INTO user_inventories (guild_id, user_id, item_name, amount)
-            VALUES ($1, $2, $3, $4) ON CONFLICT (guild_id, user_id, item_name)
-            DO UPDATE SET amount=user_inventories.amount+excluded.amount""",
-            ctx.guild.id, ctx.author.id, item_name, amount,
-        )
-        await db.disconnect()
+        if self.write_behind_enabled:
+            self.inventory_buffer.add(ctx.guild.id, ctx.author.id, item_name, amount)
+        else:
+            async with self.database() as db:
+                await db(
+                    """INSERT INTO user_inventories (guild_id, user_id, item_name, amount)
+                    VALUES ($1, $2, $3, $4) ON CONFLICT (guild_id, user_id, item_name)
+                    DO UPDATE SET amount=user_inventories.amount+excluded.amount""",
+                    ctx.guild.id, ctx.author.id, item_name, amount,
+                )
+
+        # Only record the grant once it's been written
+        self.metrics.items_granted.inc(amount, source='getitem')
+        self.item_events.add(ctx.guild.id, ctx.author.id, item_name, amount, 'getitem')
         return await ctx.send(f"You've received `{amount:,}x {item_name}`.")
 
+    @utils.Cog.listener()
+    async def on_message(self, message:discord.Message):
+        """
+        Gives users items from the guild's message acquire methods. This runs for every message the bot
+        sees, so it only touches the in-memory index of message acquire methods and cooldowns, and the
+        rewards are written by the inventory buffer in batches.
+        """
+
+        if message.guild is None or message.author.bot:
+            return
+        for acquire_information in self.message_acquire_methods.get(message.guild.id):
+            item_name = acquire_information['item_name']
+            if self.message_cooldowns.try_acquire_nowait((message.guild.id, message.author.id, item_name), acquire_information['acquire_per']):
+                continue
+            amount = random.randint(acquire_information['min_acquired'], acquire_information['max_acquired'])
+            self.inventory_buffer.add(message.guild.id, message.author.id, item_name, amount)
+            self.metrics.items_granted.inc(amount, source='message')
+            self.item_events.add(message.guild.id, message.author.id, item_name, amount, 'message')
+
+    @utils.command(aliases=['lb', 'top'])
+    @commands.bot_has_permissions(embed_links=True)
+    @commands.guild_only()
+    async def leaderboard(self, ctx:utils.Context, *, item_name:commands.clean_content=None):
+        """
+        Shows who in the guild has the most of an item, or the most items overall.
+        """
+
+        # Get the top users
+        async with self.database() as db:
+            if item_name:
+                item_name = item_name.lower()
+                rows = await db(
+                    """SELECT user_id, amount FROM user_inventories WHERE guild_id=$1 AND item_name=$2 AND amount > 0
+                    ORDER BY amount DESC LIMIT 10""",
+                    ctx.guild.id, item_name,
+                )
+            else:
+                rows = await db(
+                    "SELECT user_id, total_items AS amount FROM guild_user_wealth WHERE guild_id=$1 ORDER BY total_items DESC LIMIT 10",
+                    ctx.guild.id,
+                )
+        if not rows:
+            if item_name:
+                return await ctx.send(f"Nobody has any **{item_name}** items yet :c")
+            return await ctx.send("Nobody has any items yet :c")
+
+        # Make embed
+        with utils.Embed() as embed:
+            embed.title = f"Top {item_name} holders" if item_name else "Most items"
+            embed.description = '\n'.join([
+                f"{index}. <@{i['user_id']}> - {i['amount']:,}x" for index, i in enumerate(rows, start=1)
+            ])
+            if not item_name:
+                embed.set_footer("This leaderboard is updated every few minutes")
+        return await ctx.send(embed=embed)
+
+    @utils.command(aliases=['gift'])
+    @commands.guild_only()
+    async def give(self, ctx:utils.Context, user:discord.Member, amount:typing.Optional[int]=1, *, item_name:commands.clean_content):
+        """
+        Gives some of your items to another user.
+        """
+
+        # Make sure this is a sensible give
+        item_name = item_name.lower()
+        if user.id == ctx.author.id:
+            return await ctx.send("You can't give items to yourself.")
+        if user.bot:
+            return await ctx.send("You can't give items to bots.")
+        if amount <= 0:
+            return await ctx.send("You need to give at least one item.")
+        catalog = await self.item_cache.get(ctx.guild.id)
+        if item_name not in catalog.items:
+            return await ctx.send(f"There's no item with the name **{item_name}** in this guild.")
+
+        # Move the items
+        given = await self.transfer_items(ctx.guild.id, localutils.get_transfer_changes(ctx.author.id, user.id, {item_name: amount}))
+        if not given:
+            return await ctx.send(f"You don't have `{amount:,}x {item_name}` to give away.")
+        return await ctx.send(f"You've given `{amount:,}x {item_name}` to **{user!s}**.")
+
+    @utils.command()
+    @commands.bot_has_permissions(add_reactions=True, send_messages=True)
+    @commands.guild_only()
+    async def trade(self, ctx:utils.Context, user:discord.Member, *, offer:commands.clean_content):
+        """
+        Offers some of your items for some of another user's (eg `5 wood, 2 stone for 1 iron axe`).
+        """
+
+        # Work out what's being traded
+        if user.id == ctx.author.id:
+            return await ctx.send("You can't trade with yourself.")
+        if user.bot:
+            return await ctx.send("You can't trade with bots.")
+        offer_text, separator, request_text = offer.lower().partition(' for ')
+        if not separator:
+            return await ctx.send(f"You need to say what you're offering and what you want for it (eg `{ctx.clean_prefix}trade {user!s} 5 wood, 2 stone for 1 iron axe`).")
+        try:
+            offered_items = self.parse_item_amounts(offer_text)
+            requested_items = self.parse_item_amounts(request_text)
+        except ValueError as e:
+            return await ctx.send(str(e))
+        if not offered_items or not requested_items:
+            return await ctx.send("You need to offer at least one item and ask for at least one item.")
+        catalog = await self.item_cache.get(ctx.guild.id)
+        invalid_items = set(offered_items).union(requested_items).difference(catalog.items)
+        if invalid_items:
+            return await ctx.send(f"There are no items called {', '.join(f'**{i}**' for i in sorted(invalid_items))} in this guild.")
+
+        # See if the other user wants it
+        offered_string = ', '.join([f"`{o:,}x {i}`" for i, o in offered_items.items()])
+        requested_string = ', '.join([f"`{o:,}x {i}`" for i, o in requested_items.items()])
+        valid_reactions = ["\N{HEAVY CHECK MARK}", "\N{HEAVY MULTIPLICATION X}"]
+        trade_message = await ctx.send(f"{user.mention}, **{ctx.author!s}** would like to trade you {offered_string} for {requested_string}. Do you accept?")
+        await asyncio.gather(*[trade_message.add_reaction(e) for e in valid_reactions])
+        try:
+            with localutils.untimed():
+                reaction, _ = await self.bot.wait_for(
+                    "reaction_add", timeout=120.0,
+                    check=lambda r, u: str(r.emoji) in valid_reactions and u.id == user.id and r.message.id == trade_message.id,
+                )
+        except asyncio.TimeoutError:
+            return await ctx.send(f"**{user!s}** didn't respond to the trade in time.")
+        if str(reaction.emoji) == "\N{HEAVY MULTIPLICATION X}":
+            return await ctx.send(f"**{user!s}** declined the trade.")
+
+        # Swap the items
+        changes = localutils.get_transfer_changes(ctx.author.id, user.id, offered_items)
+        for key, amount in localutils.get_transfer_changes(user.id, ctx.author.id, requested_items).items():
+            changes[key] = changes.get(key, 0) + amount
+        traded = await self.transfer_items(ctx.guild.id, changes)
+        if not traded:
+            return await ctx.send("One of you doesn't have enough items for this trade any more - please try again later.")
+        return await ctx.send(f"Trade complete! **{ctx.author!s}** gave {offered_string} to **{user!s}** for {requested_string}.")
+
+    @utils.command(aliases=['payout'])
+    @commands.has_permissions(manage_guild=True)
+    @commands.guild_only()
+    async def giverole(self, ctx:utils.Context, role:discord.Role, amount:typing.Optional[int]=1, *, item_name:commands.clean_content):
+        """
+        Gives every member of a role some of an item.
+        """
+
+        # Make sure this is a sensible payout
+        item_name = item_name.lower()
+        if amount <= 0:
+            return await ctx.send("You need to give at least one item.")
+        catalog = await self.item_cache.get(ctx.guild.id)
+        if item_name not in catalog.items:
+            return await ctx.send(f"There's no item with the name **{item_name}** in this guild.")
+        user_ids = [i.id for i in role.members if not i.bot]
+        if not user_ids:
+            return await ctx.send(f"Nobody has the **{role.name}** role.")
+
+        # Pay everyone at once
+        async with ctx.typing():
+            async with self.database() as db:
+                await localutils.give_items_to_users(db, ctx.guild.id, user_ids, item_name, amount)
+        self.metrics.items_granted.inc(amount * len(user_ids), source='role')
+        for user_id in user_ids:
+            self.item_events.add(ctx.guild.id, user_id, item_name, amount, 'role')
+        return await ctx.send(f"Gave `{amount:,}x {item_name}` to `{len(user_ids):,}` members of **{role.name}**.")
+
+    @utils.command(aliases=['createshopitem', 'shopitem'])
+    @commands.has_permissions(manage_guild=True)
+    @commands.bot_has_permissions(add_reactions=True, embed_links=True)
+    @commands.guild_only()
+    async def addshopitem(self, ctx:utils.Context, *, offer:commands.clean_content):
+        """
+        Posts a shop message that users can react to to buy an item (eg `1 iron axe for 5 wood`).
+        """
+
+        # Work out what's being sold
+        item_text, separator, price_text = offer.lower().partition(' for ')
+        if not separator:
+            return await ctx.send(f"You need to say what's being sold and what it costs (eg `{ctx.clean_prefix}addshopitem 1 iron axe for 5 wood`).")
+        try:
+            sold_items = self.parse_item_amounts(item_text)
+            price_items = self.parse_item_amounts(price_text)
+        except ValueError as e:
+            return await ctx.send(str(e))
+        if len(sold_items) != 1 or len(price_items) != 1:
+            return await ctx.send("A shop message sells one item for one other item.")
+        (item_name, amount_gained), = sold_items.items()
+        (item_required, required_item_amount), = price_items.items()
+        if item_name == item_required:
+            return await ctx.send("You can't sell an item for itself.")
+        catalog = await self.item_cache.get(ctx.guild.id)
+        invalid_items = {item_name, item_required}.difference(catalog.items)
+        if invalid_items:
+            return await ctx.send(f"There are no items called {', '.join(f'**{i}**' for i in sorted(invalid_items))} in this guild.")
+
+        # Post the shop message
+        with utils.Embed() as embed:
+            embed.title = f"Buy {item_name}"
+            embed.description = f"React with {localutils.SHOP_EMOJI} to buy **{amount_gained:,}x {item_name}** for **{required_item_amount:,}x {item_required}**."
+        shop_message = await ctx.send(embed=embed)
+        await shop_message.add_reaction(localutils.SHOP_EMOJI)
+
+        # And save it
+        offer = localutils.ShopOffer(ctx.guild.id, shop_message.id, item_name, amount_gained, item_required, required_item_amount)
+        async with self.database() as db:
+            await db(
+                """INSERT INTO guild_item_shop_messages (guild_id, item_name, message_id, amount_gained, item_required, required_item_amount)
+                VALUES ($1, $2, $3, $4, $5, $6)""",
+                offer.guild_id, offer.item_name, offer.message_id, offer.amount_gained, offer.item_required, offer.required_item_amount,
+            )
+        self.shop_index.add(offer)
+
+    @utils.command(aliases=['deleteshopitem'])
+    @commands.has_permissions(manage_guild=True)
+    @commands.guild_only()
+    async def removeshopitem(self, ctx:utils.Context, message_id:int):
+        """
+        Stops a shop message from selling anything.
+        """
+
+        offer = self.shop_index.get(message_id)
+        if offer is None or offer.guild_id != ctx.guild.id:
+            return await ctx.send("There's no shop message with that ID in this guild.")
+        await self.delete_shop_message(offer.guild_id, message_id)
+        return await ctx.send(f"That message won't sell **{offer.item_name}** any more.")
+
+    async def delete_shop_message(self, guild_id:int, message_id:int) -> None:
+        self.shop_index.remove(message_id)
+        async with self.database() as db:
+            await db("DELETE FROM guild_item_shop_messages WHERE guild_id=$1 AND message_id=$2", guild_id, message_id)
+
+    @utils.Cog.listener()
+    async def on_raw_reaction_add(self, payload:discord.RawReactionActionEvent):
+        """
+        Sells an item to a user who reacted to a shop message. Reactions on anything else are dropped
+        by the in-memory index before any work is done.
+        """
+
+        # See if this is a purchase
+        offer = self.shop_index.get(payload.message_id)
+        if offer is None or offer.guild_id != payload.guild_id:
+            return
+        if str(payload.emoji) != localutils.SHOP_EMOJI or payload.user_id == self.bot.user.id:
+            return
+        if payload.member is not None and payload.member.bot:
+            return
+
+        # Swap their items
+        await self.inventory_buffer.flush(offer.guild_id, payload.user_id)
+        async with self.database() as db:
+            bought = await localutils.exchange_items(
+                db, offer.guild_id, payload.user_id, offer.item_required, offer.required_item_amount,
+                offer.item_name, offer.amount_gained,
+            )
+
+        if bought:
+            self.item_events.add(offer.guild_id, payload.user_id, offer.item_required, -offer.required_item_amount, 'shop')
+            self.item_events.add(offer.guild_id, payload.user_id, offer.item_name, offer.amount_gained, 'shop')
+
+        # Let them buy again and tell them how it went
+        channel = self.bot.get_channel(payload.channel_id)
+        if channel is None:
+            return
+        try:
+            await self.bot.http.remove_reaction(payload.channel_id, payload.message_id, localutils.SHOP_EMOJI, payload.user_id)
+        except discord.HTTPException:
+            pass
+        if bought:
+            text = f"<@{payload.user_id}>, you bought **{offer.amount_gained:,}x {offer.item_name}** for **{offer.required_item_amount:,}x {offer.item_required}**."
+        else:
+            text = f"<@{payload.user_id}>, you need **{offer.required_item_amount:,}x {offer.item_required}** to buy **{offer.item_name}**."
+        try:
+            await channel.send(text, delete_after=10)
+        except discord.HTTPException:
+            pass
+
+    @utils.Cog.listener()
+    async def on_raw_message_delete(self, payload:discord.RawMessageDeleteEvent):
+        """
+        Removes shop messages that have been deleted.
+        """
+
+        if payload.message_id in self.shop_index:
+            await self.delete_shop_message(payload.guild_id, payload.message_id)
+
     @utils.command(ignore_extra=False, aliases=['makeitem', 'additem'])
     @commands.has_permissions(manage_guild=True)
     @commands.guild_only()
@@ -168,13 +870,47 @@ class ItemCommands(utils.Cog):
         """
 
         item_name = item_name.lower()
-        async with self.bot.database() as db:
+        async with self.database() as db:
             try:
                 await db("INSERT INTO guild_items (guild_id, item_name) VALUES ($1, $2)", ctx.guild.id, item_name)
             except asyncpg.UniqueViolationError:
                 return await ctx.send(f"There's already an item with the name **{item_name}** in your guild.")
+        self.invalidate_guild_data(ctx.guild.id)
         return await ctx.send(f"Added an item with name **{item_name}** to your guild. Add acquire methods with the `{ctx.clean_prefix}getitem {item_name}` command.")
 
+    # The steps of the item setup flows - whether each one takes a message as an answer, and which reactions it takes
+    SETUP_STATES = {
+        'choose_method': (False, ["\N{BLUE HEART}", "\N{GREEN HEART}", "\N{YELLOW HEART}", "\N{HEAVY MULTIPLICATION X}"]),
+        'acquire_existing': (False, ["\N{HEAVY MULTIPLICATION X}", "\N{BLACK QUESTION MARK ORNAMENT}"]),
+        'acquire_minimum': (True, []),
+        'acquire_maximum': (True, []),
+        'acquire_per': (True, []),
+        'recipe_existing': (False, ["\N{HEAVY MULTIPLICATION X}", "\N{BLACK QUESTION MARK ORNAMENT}"]),
+        'recipe_first_ingredient': (True, []),
+        'recipe_ingredient': (True, ["\N{HEAVY MULTIPLICATION X}"]),
+        'recipe_amount': (True, []),
+    }
+
+    # What to say while setting up each kind of acquire method
+    ACQUIRE_SETUP_TEXT = {
+        'Command': {
+            'flow': "command",
+            'existing': "You already have an acquire method set up for commands via the `{prefix}getitem {item_name}` command. Would you like to remove this command (\N{HEAVY MULTIPLICATION X}) or change how the command works (\N{BLACK QUESTION MARK ORNAMENT})?",
+            'deleted': "Deleted the `{prefix}getitem {item_name}` command.",
+            'minimum': "When the `{prefix}getitem {item_name}` command is run, they'll be given a random amount of the item - what's the _minimum_ you want users to be able to get?",
+            'per': "Obviously the command shouldn't be run all the time - how often should users be able to run the command (eg `1h`, `5m`, etc)?",
+            'saved': "Information saved to database - you can now acquire between `{random_min:,}` and `{random_max:,}` of **{item_name}** every `{acquire_per}` via the `{prefix}getitem {item_name}` command.",
+        },
+        'Message': {
+            'flow': "messages",
+            'existing': "You already have an acquire method set up for **{item_name}** via sending messages. Would you like to remove this (\N{HEAVY MULTIPLICATION X}) or change how it works (\N{BLACK QUESTION MARK ORNAMENT})?",
+            'deleted': "Users will no longer get **{item_name}** from sending messages.",
+            'minimum': "When a user sends a message, they'll be given a random amount of **{item_name}** - what's the _minimum_ you want users to be able to get?",
+            'per': "Users shouldn't get items for every message they send - how often should a user be able to get the item (eg `1m`, `30s`, etc)?",
+            'saved': "Information saved to database - users will now get between `{random_min:,}` and `{random_max:,}` of **{item_name}** from sending a message, at most once every `{acquire_per}`.",
+        },
+    }
+
     @utils.command()
     @commands.has_permissions(manage_guild=True)
     @commands.bot_has_permissions(add_reactions=True, send_messages=True)
@@ -186,269 +922,428 @@ class ItemCommands(utils.Cog):
 
         # Make sure the item exists
         item_name = item_name.lower()
-        async with self.bot.database() as db:
-            rows = await db("SELECT * FROM guild_items WHERE guild_id=$1 AND item_name=$2", ctx.guild.id, item_name)
-        if not rows:
+        catalog = await self.item_cache.get(ctx.guild.id)
+        if item_name not in catalog.items:
             return await ctx.send(f"There's no item with the name **{item_name}** in your guild. If you want one, you can set one up with `{ctx.clean_prefix}createitem {item_name}`.")
 
-        # Send initial message
+        # Start a setup session - the rest of the flow is driven by their answers
         self.logger.info(f"Setting up an item acquire for '{item_name}' in {ctx.guild.id}")
-        command_message = await ctx.send("You can set up items to be acquired via messages sent (like level up exp, \N{BLUE HEART}), via command (like a daily command \N{GREEN HEART}), and/or via crafting (\N{YELLOW HEART}). What would you like to set up now?")
-        valid_reactions = ["\N{BLUE HEART}", "\N{GREEN HEART}", "\N{YELLOW HEART}", "\N{HEAVY MULTIPLICATION X}"]
-        for e in valid_reactions:
-            await command_message.add_reaction(e)
+        session = localutils.SetupSession(ctx.channel.id, ctx.author.id, ctx.guild.id, item_name, 'choose_method', {'prefix': ctx.clean_prefix})
+        await self.prompt_setup_session(
+            session, ctx.channel,
+            "You can set up items to be acquired via messages sent (like level up exp, \N{BLUE HEART}), via command (like a daily command \N{GREEN HEART}), and/or via crafting (\N{YELLOW HEART}). What would you like to set up now?",
+        )
 
-        # Wait for a result
-        try:
-            reaction, _ = await self.bot.wait_for(
-                "reaction_add", timeout=120.0,
-                check=self.get_reaction_add_check(ctx, command_message, valid_reactions),
-                # check=lambda r, u: str(r.emoji) in valid_reactions and u.id == ctx.author.id and r.message.id == ctx.message.id
-            )
-            emoji = str(reaction.emoji)
-        except asyncio.TimeoutError:
-            self.logger.info(f"Timed out setting up item acquire for '{item_name}' in {ctx.guild.id}")
-            return await ctx.send("Timed out setting up an item acquirement method - please try again later.")
+    async def prompt_setup_session(self, session:localutils.SetupSession, channel:discord.TextChannel, text:str) -> None:
+        """
+        Asks the question for a session's current step, then stores the session to wait for the answer.
+        """
 
-        # They wanna abort
-        if emoji == "\N{HEAVY MULTIPLICATION X}":
-            self.logger.info(f"Aborted setting up item acquire for '{item_name}' in {ctx.guild.id}")
-            return await ctx.send(f"Alright, aborting setting up an item acquire method for '{item_name}'.")
+        prompt_message = await channel.send(text)
+        session.prompt_message_id = prompt_message.id
+        await asyncio.gather(
+            self.setup_sessions.save(session),
+            *[prompt_message.add_reaction(e) for e in self.SETUP_STATES[session.state][1]],
+        )
+
+    async def end_setup_session(self, session:localutils.SetupSession, channel:discord.TextChannel, text:str) -> None:
+        await self.setup_sessions.end(session)
+        await channel.send(text)
 
-        # They wanna set up a command
-        elif emoji == "\N{GREEN HEART}":
-            self.logger.info(f"Setting up a command acquire for '{item_name}' in {ctx.guild.id}")
-            return await self.set_up_acquire_command(ctx, item_name)
+    @utils.Cog.listener('on_message')
+    async def dispatch_setup_message(self, message:discord.Message):
+        """
+        Passes a message to the setup session that's waiting on its author in that channel, if there is one.
+        """
 
-        # They wanna set up messasge acquire
-        elif emoji == "\N{BLUE HEART}":
-            self.logger.info(f"Setting up a message acquire for '{item_name}' in {ctx.guild.id}")
-            return await self.set_up_message_acquire(ctx, item_name)
+        if message.guild is None or message.author.bot or not message.content:
+            return
+        if self.setup_sessions.get(message.channel.id, message.author.id) is None:
+            return
+        await self.handle_setup_answer(message.channel, message.author.id, content=message.content)
 
-        # They wanna set up messasge acquire
-        elif emoji == "\N{YELLOW HEART}":
-            self.logger.info(f"Setting up a crafting recipe for '{item_name}' in {ctx.guild.id}")
-            return await self.set_up_crafting_recipe(ctx, item_name)
+    @utils.Cog.listener('on_raw_reaction_add')
+    async def dispatch_setup_reaction(self, payload:discord.RawReactionActionEvent):
+        """
+        Passes a reaction to the setup session that's waiting on the user who added it, if it was added to
+        the session's latest prompt.
+        """
 
-        # And they managed to get something else
-        self.logger.info(f"Fucked up setting up item acquire for '{item_name}' in {ctx.guild.id} - managed to pass with a {emoji} emoji")
-        return await ctx.send("I don't think you should ever see this message.")
+        session = self.setup_sessions.get(payload.channel_id, payload.user_id)
+        if session is None or session.prompt_message_id != payload.message_id:
+            return
+        channel = self.bot.get_channel(payload.channel_id)
+        if channel is None:
+            return
+        await self.handle_setup_answer(channel, payload.user_id, emoji=str(payload.emoji), message_id=payload.message_id)
 
-    async def set_up_acquire_command(self, ctx:utils.Context, item_name:str):
+    async def handle_setup_answer(
+            self, channel:discord.TextChannel, user_id:int, *, content:str=None, emoji:str=None, message_id:int=None) -> None:
         """
-        Talks the user through setting up a command where the user an acquire an item.
+        Runs the handler for a session's current step with the user's answer.
         """
 
-        # See if stuff's already been set up
-        async with self.bot.database() as db:
-            rows = await db("SELECT * FROM guild_item_acquire_methods WHERE guild_id=$1 AND item_name=$2 AND acquired_by='Command'", ctx.guild.id, item_name)
+        async with self.setup_sessions.lock((channel.id, user_id)):
+
+            # Make sure the session's still waiting on this answer
+            session = self.setup_sessions.get(channel.id, user_id)
+            if session is None:
+                return
+            takes_messages, valid_reactions = self.SETUP_STATES[session.state]
+            if content is not None and not takes_messages:
+                return
+            if emoji is not None and (emoji not in valid_reactions or message_id != session.prompt_message_id):
+                return
 
-        if rows:
-            # See if they want to remove their current setup
-            valid_reactions = ["\N{HEAVY MULTIPLICATION X}", "\N{BLACK QUESTION MARK ORNAMENT}"]
-            acquire_method_setup = await ctx.send(f"You already have an acquire method set up for commands via the `{ctx.clean_prefix}getitem {item_name}` command. Would you like to remove this command (\N{HEAVY MULTIPLICATION X}) or change how the command works (\N{BLACK QUESTION MARK ORNAMENT})?")
-            for e in valid_reactions:
-                await acquire_method_setup.add_reaction(e)
+            # And run it
             try:
-                reaction, _ = await self.bot.wait_for(
-                    "reaction_add", timeout=120.0,
-                    check=self.get_reaction_add_check(ctx, acquire_method_setup, valid_reactions)
-                )
-                emoji = str(reaction.emoji)
-            except asyncio.TimeoutError:
-                return await ctx.send("Timed out setting up an item acquirement via command - please try again later.")
-
-            # See if they just wanna delete
-            if emoji == "\N{HEAVY MULTIPLICATION X}":
-                async with self.bot.database() as db:
-                    await db("DELETE FROM guild_item_acquire_methods WHERE guild_id=$1 AND item_name=$2 AND acquired_by='Command'", ctx.guild.id, item_name)
-                return await ctx.send(f"Deleted the `{ctx.clean_prefix}getitem {item_name}` command.")
-
-        # See their random amount minimum
-        await ctx.send(f"When the `{ctx.clean_prefix}getitem {item_name}` command is run, they'll be given a random amount of the item - what's the _minimum_ you want users to be able to get?")
-        try:
-            user_message_minimum = await self.bot.wait_for(
-                "message", timeout=120.0,
-                check=lambda m: m.channel.id == ctx.channel.id and m.author.id == ctx.author.id and m.content
-            )
-            if not user_message_minimum.content.isdigit():
-                their_value = await commands.clean_content().convert(ctx, user_message_minimum.content)
-                return await ctx.send(f"I couldn't convert `{their_value}` into an integer - please try again later.")
-        except asyncio.TimeoutError:
-            return await ctx.send("Timed out setting up an item acquirement via command - please try again later.")
+                await getattr(self, f"setup_{session.state}")(session, channel, content=content, emoji=emoji)
+            except Exception:
+                await self.setup_sessions.end(session)
+                raise
 
-        # See their random amount maximum
-        await ctx.send("What's the _maximum_ you want users to be able to get?")
-        try:
-            user_message_maximum = await self.bot.wait_for(
-                "message", timeout=120.0,
-                check=lambda m: m.channel.id == ctx.channel.id and m.author.id == ctx.author.id and m.content
-            )
-            if not user_message_maximum.content.isdigit():
-                their_value = await commands.clean_content().convert(ctx, user_message_maximum.content)
-                return await ctx.send(f"I couldn't convert `{their_value}` into an integer - please try again later.")
-        except asyncio.TimeoutError:
-            return await ctx.send("Timed out setting up an item acquirement via command - please try again later.")
+    @tasks.loop(seconds=10)
+    async def expire_setup_sessions(self):
+        """
+        Ends the setup sessions that the user stopped answering.
+        """
 
-        # See how often the command should be able to be run
-        await ctx.send("Obviously the command shouldn't be run all the time - how often should users be able to run the command (eg `1h`, `5m`, etc)?")
         try:
-            user_message_timeout = await self.bot.wait_for(
-                "message", timeout=120.0,
-                check=lambda m: m.channel.id == ctx.channel.id and m.author.id == ctx.author.id and m.content
-            )
+            expired = await self.setup_sessions.pop_expired()
+        except Exception as e:
+            self.logger.error(f"Failed to expire setup sessions - {e}")
+            return
+        for session in expired:
+            self.logger.info(f"Timed out setting up item acquire for '{session.item_name}' in {session.guild_id}")
+            channel = self.bot.get_channel(session.channel_id)
+            if channel is None:
+                continue
+            flow = session.data.get('flow')
+            text = f"Timed out setting up an item acquirement via {flow}" if flow else "Timed out setting up an item acquirement method"
             try:
-                timeout_timevalue = await utils.TimeValue.convert(ctx, user_message_timeout.content)
-            except commands.BadArgument:
-                their_value = await commands.clean_content().convert(ctx, timeout_timevalue.content)
-                return await ctx.send(f"I couldn't convert `{their_value}` into a time value - please try again later.")
-        except asyncio.TimeoutError:
-            return await ctx.send("Timed out setting up an item acquirement via command - please try again later.")
+                await channel.send(f"<@{session.user_id}> {text} - please try again later.")
+            except discord.HTTPException:
+                pass
+
+    @expire_setup_sessions.before_loop
+    async def before_expire_setup_sessions(self):
+        await self.bot.wait_until_ready()
+
+    async def setup_choose_method(self, session:localutils.SetupSession, channel:discord.TextChannel, *, emoji:str, **kwargs):
+        """
+        Handles the user picking which kind of acquire method to set up.
+        """
+
+        # They wanna abort
+        if emoji == "\N{HEAVY MULTIPLICATION X}":
+            self.logger.info(f"Aborted setting up item acquire for '{session.item_name}' in {session.guild_id}")
+            return await self.end_setup_session(session, channel, f"Alright, aborting setting up an item acquire method for '{session.item_name}'.")
+
+        # They wanna set up a command or message acquire
+        catalog = await self.item_cache.get(session.guild_id)
+        if emoji in ("\N{GREEN HEART}", "\N{BLUE HEART}"):
+            acquired_by = 'Command' if emoji == "\N{GREEN HEART}" else 'Message'
+            self.logger.info(f"Setting up a {acquired_by.lower()} acquire for '{session.item_name}' in {session.guild_id}")
+            text = self.ACQUIRE_SETUP_TEXT[acquired_by]
+            session.data.update(acquired_by=acquired_by, flow=text['flow'])
+            if (session.item_name, acquired_by) in catalog.acquire_methods:
+                session.state = 'acquire_existing'
+                return await self.prompt_setup_session(session, channel, text['existing'].format(**session.data, item_name=session.item_name))
+            return await self.prompt_acquire_minimum(session, channel)
+
+        # They wanna set up a crafting recipe
+        self.logger.info(f"Setting up a crafting recipe for '{session.item_name}' in {session.guild_id}")
+        session.data.update(flow="crafting", ingredients=[])
+        if session.item_name in catalog.craftable_items:
+            session.state = 'recipe_existing'
+            return await self.prompt_setup_session(
+                session, channel,
+                f"You already have an acquire method set up for crafting via the `{session.data['prefix']}craftitem {session.item_name}` command. Would you like to remove this (\N{HEAVY MULTIPLICATION X}) or change how the crafting works (\N{BLACK QUESTION MARK ORNAMENT})?",
+            )
+        return await self.prompt_recipe_first_ingredient(session, channel)
+
+    async def setup_acquire_existing(self, session:localutils.SetupSession, channel:discord.TextChannel, *, emoji:str, **kwargs):
+        """
+        Handles the user picking whether to remove or change an acquire method that's already set up.
+        """
+
+        if emoji == "\N{HEAVY MULTIPLICATION X}":
+            async with self.database() as db:
+                await db(
+                    "DELETE FROM guild_item_acquire_methods WHERE guild_id=$1 AND item_name=$2 AND acquired_by=$3",
+                    session.guild_id, session.item_name, session.data['acquired_by'],
+                )
+            self.invalidate_guild_data(session.guild_id)
+            text = self.ACQUIRE_SETUP_TEXT[session.data['acquired_by']]['deleted']
+            return await self.end_setup_session(session, channel, text.format(**session.data, item_name=session.item_name))
+        return await self.prompt_acquire_minimum(session, channel)
+
+    async def prompt_acquire_minimum(self, session:localutils.SetupSession, channel:discord.TextChannel):
+        session.state = 'acquire_minimum'
+        text = self.ACQUIRE_SETUP_TEXT[session.data['acquired_by']]['minimum']
+        return await self.prompt_setup_session(session, channel, text.format(**session.data, item_name=session.item_name))
+
+    async def setup_acquire_minimum(self, session:localutils.SetupSession, channel:discord.TextChannel, *, content:str, **kwargs):
+        """
+        Handles the user giving the minimum amount of an item that can be acquired.
+        """
+
+        if not content.isdigit():
+            return await self.end_setup_session(session, channel, f"I couldn't convert `{discord.utils.escape_mentions(content)}` into an integer - please try again later.")
+        session.data['minimum'] = int(content)
+        session.state = 'acquire_maximum'
+        return await self.prompt_setup_session(session, channel, "What's the _maximum_ you want users to be able to get?")
+
+    async def setup_acquire_maximum(self, session:localutils.SetupSession, channel:discord.TextChannel, *, content:str, **kwargs):
+        """
+        Handles the user giving the maximum amount of an item that can be acquired.
+        """
+
+        if not content.isdigit():
+            return await self.end_setup_session(session, channel, f"I couldn't convert `{discord.utils.escape_mentions(content)}` into an integer - please try again later.")
+        session.data['maximum'] = int(content)
+        session.state = 'acquire_per'
+        text = self.ACQUIRE_SETUP_TEXT[session.data['acquired_by']]['per']
+        return await self.prompt_setup_session(session, channel, text)
+
+    async def setup_acquire_per(self, session:localutils.SetupSession, channel:discord.TextChannel, *, content:str, **kwargs):
+        """
+        Handles the user giving how often an item can be acquired, and saves the acquire method.
+        """
 
         # Validate our information
-        command_random_amounts = [int(user_message_maximum.content), int(user_message_minimum.content)]
-        random_max = max(command_random_amounts)
-        random_min = min(command_random_amounts)
-        # timeout_timevalue is also here
+        try:
+            timeout_timevalue = utils.TimeValue.parse(content)
+        except commands.BadArgument:
+            return await self.end_setup_session(session, channel, f"I couldn't convert `{discord.utils.escape_mentions(content)}` into a time value - please try again later.")
+        random_max = max(session.data['minimum'], session.data['maximum'])
+        random_min = min(session.data['minimum'], session.data['maximum'])
 
         # Save the information to database
-        async with self.bot.database() as db:
+        async with self.database() as db:
             await db(
                 """INSERT INTO guild_item_acquire_methods (guild_id, item_name, acquired_by, min_acquired,
-                max_acquired, acquire_per) VALUES ($1, $2, 'Command', $3, $4, $5) ON CONFLICT (guild_id, item_name, acquired_by) DO UPDATE
-                SET min_acquired=$3, max_acquired=$4, acquire_per=$5""",
-                ctx.guild.id, item_name, random_min, random_max, timeout_timevalue.delta.total_seconds()
+                max_acquired, acquire_per) VALUES ($1, $2, $3, $4, $5, $6) ON CONFLICT (guild_id, item_name, acquired_by) DO UPDATE
+                SET min_acquired=$4, max_acquired=$5, acquire_per=$6""",
+                session.guild_id, session.item_name, session.data['acquired_by'], random_min, random_max,
+                timeout_timevalue.delta.total_seconds(),
             )
-        return await ctx.send(f"Information saved to database - you can now acquire between `{random_min:,}` and `{random_max:,}` of **{item_name}** every `{timeout_timevalue.clean_spaced}` via the `{ctx.clean_prefix}getitem {item_name}` command.")
+        self.invalidate_guild_data(session.guild_id)
+        text = self.ACQUIRE_SETUP_TEXT[session.data['acquired_by']]['saved']
+        return await self.end_setup_session(session, channel, text.format(
+            **session.data, item_name=session.item_name, random_min=random_min, random_max=random_max,
+            acquire_per=timeout_timevalue.clean_spaced,
+        ))
+
+    async def setup_recipe_existing(self, session:localutils.SetupSession, channel:discord.TextChannel, *, emoji:str, **kwargs):
+        """
+        Handles the user picking whether to remove or change a crafting recipe that's already set up.
+        """
 
-    async def set_up_message_acquire(self, ctx:utils.Context, item_name:str):
+        # See if they just wanna delete - the ingredients go with the recipe
+        if emoji == "\N{HEAVY MULTIPLICATION X}":
+            async with self.database() as db:
+                await db("DELETE FROM craftable_items WHERE guild_id=$1 AND item_name=$2", session.guild_id, session.item_name)
+            self.invalidate_guild_data(session.guild_id)
+            return await self.end_setup_session(session, channel, f"Deleted the crafting recipe for `{session.item_name}` items.")
+        return await self.prompt_recipe_first_ingredient(session, channel)
+
+    async def prompt_recipe_first_ingredient(self, session:localutils.SetupSession, channel:discord.TextChannel):
+        session.state = 'recipe_first_ingredient'
+        return await self.prompt_setup_session(
+            session, channel,
+            "What item, and how many of that item, make up an ingredient of this crafting recipe (eg `5 cat`, `1 pizza slice`, `69 bee`, etc)?\n(Items are not checked until the end, so make sure you're spelling things correctly)",
+        )
+
+    async def setup_recipe_first_ingredient(self, session:localutils.SetupSession, channel:discord.TextChannel, *, content:str, **kwargs):
         """
-        Talks the user through setting up item acquires via message sends.
+        Handles the user giving the first ingredient of a crafting recipe.
         """
 
-        return await ctx.send("I didn't actually code this yet so whoops")
+        return await self.add_recipe_ingredient(session, channel, content)
 
-    async def set_up_crafting_recipe(self, ctx:utils.Context, item_name:str):
+    async def setup_recipe_ingredient(self, session:localutils.SetupSession, channel:discord.TextChannel, *, content:str=None, emoji:str=None):
         """
-        Talks the user through setting up an item crafting recipe.
+        Handles the user giving another ingredient of a crafting recipe, or saying that they're done.
         """
 
-        # See if stuff's already been set up
-        async with self.bot.database() as db:
-            rows = await db("SELECT * FROM craftable_items WHERE guild_id=$1 AND item_name=$2", ctx.guild.id, item_name)
+        if content is not None:
+            return await self.add_recipe_ingredient(session, channel, content)
+        session.state = 'recipe_amount'
+        return await self.prompt_setup_session(session, channel, f"How many `{session.item_name}` should be created from this crafting recipe?")
 
-        if rows:
-            # See if they want to remove their current setup
-            valid_reactions = ["\N{HEAVY MULTIPLICATION X}", "\N{BLACK QUESTION MARK ORNAMENT}"]
-            acquire_method_setup = await ctx.send(f"You already have an acquire method set up for crafting via the `{ctx.clean_prefix}craftitem {item_name}` command. Would you like to remove this (\N{HEAVY MULTIPLICATION X}) or change how the crafting works (\N{BLACK QUESTION MARK ORNAMENT})?")
-            for e in valid_reactions:
-                await acquire_method_setup.add_reaction(e)
-            try:
-                reaction, _ = await self.bot.wait_for(
-                    "reaction_add", timeout=120.0,
-                    check=self.get_reaction_add_check(ctx, acquire_method_setup, valid_reactions)
-                )
-                emoji = str(reaction.emoji)
-            except asyncio.TimeoutError:
-                return await ctx.send("Timed out setting up an item acquirement via crafting - please try again later.")
-
-            # See if they just wanna delete
-            if emoji == "\N{HEAVY MULTIPLICATION X}":
-                async with self.bot.database() as db:
-                    await db("DELETE FROM craftable_items WHERE guild_id=$1 AND item_name=$2", ctx.guild.id, item_name)
-                    await db("DELETE FROM craftable_item_ingredients WHERE guild_id=$1 AND item_name=$2", ctx.guild.id, item_name)
-                return await ctx.send(f"Deleted the crafting recipe for `{item_name}` items.")
-            async with self.bot.database() as db:
-                await db("DELETE FROM craftable_items WHERE guild_id=$1 AND item_name=$2", ctx.guild.id, item_name)
-                await db("DELETE FROM craftable_item_ingredients WHERE guild_id=$1 AND item_name=$2", ctx.guild.id, item_name)
-
-        ingredient_list = []
-
-        # Ask what the item will be made from initially
-        ingredient_bot_message = await ctx.send("What item, and how many of that item, make up an ingredient of this crafting recipe (eg `5 cat`, `1 pizza slice`, `69 bee`, etc)?\n(Items are not checked until the end, so make sure you're spelling things correctly)")
-        try:
-            ingredient_user_message = await self.bot.wait_for(
-                "message", timeout=120.0,
-                check=lambda m: m.author.id == ctx.author.id and m.channel.id == ctx.channel.id and m.content,
-            )
-        except asyncio.TimeoutError:
-            return await ctx.send("Timed out setting up an item acquirement via crafting - please try again later.")
+    async def add_recipe_ingredient(self, session:localutils.SetupSession, channel:discord.TextChannel, content:str):
+        """
+        Parses an ingredient and asks for the next one.
+        """
 
-        # Parse ingredient
-        amount_str, *ingredient_name = ingredient_user_message.content.split(' ')
+        amount_str, *ingredient_name = content.split(' ')
         if not amount_str.isdigit():
-            their_value = await commands.clean_content().convert(ctx, amount_str)
-            return await ctx.send(f"I couldn't convert `{their_value}` into an integer - please try again later.")
-        ingredient_list.append((int(amount_str), ' '.join(ingredient_name)))
-
-        # Ask about the rest of the ingredients
-        while True:
-            ingredient_bot_message = await ctx.send("Is there another item that's part of this recipe (eg `5 cat`, `1 pizza slice`, `69 bee`, etc)? If not, just react (\N{HEAVY MULTIPLICATION X}) below.")
-            await ingredient_bot_message.add_reaction("\N{HEAVY MULTIPLICATION X}")
-            try:
-                done, pending = await asyncio.wait([
-                    self.bot.wait_for('message', check=lambda m: m.author.id == ctx.author.id and m.channel.id == ctx.channel.id and m.content),
-                    self.bot.wait_for('reaction_add', check=self.get_reaction_add_check(ctx, ingredient_bot_message, ["\N{HEAVY MULTIPLICATION X}"])),
-                ], return_when=asyncio.FIRST_COMPLETED, timeout=120.0)
-                for future in pending:
-                    future.cancel()  # we don't need these anymore
-            except asyncio.TimeoutError:
-                return await ctx.send("Timed out setting up an item acquirement via crafting - please try again later.")
-
-            # Did they message or react?
-            result = done.pop().result()
-            if isinstance(result, discord.Message):
-                ingredient_user_message = result
-            else:
-                break
+            return await self.end_setup_session(session, channel, f"I couldn't convert `{discord.utils.escape_mentions(amount_str)}` into an integer - please try again later.")
+        if int(amount_str) < 1:
+            text = "Ingredients need an amount of at least 1 - what item, and how many of that item, make up this ingredient (eg `5 cat`, `1 pizza slice`, `69 bee`, etc)?"
+            if session.state == 'recipe_ingredient':
+                text += " If there aren't any more, just react (\N{HEAVY MULTIPLICATION X}) below."
+            return await self.prompt_setup_session(session, channel, text)
+        session.data['ingredients'].append((int(amount_str), ' '.join(ingredient_name)))
+        session.state = 'recipe_ingredient'
+        return await self.prompt_setup_session(
+            session, channel,
+            "Is there another item that's part of this recipe (eg `5 cat`, `1 pizza slice`, `69 bee`, etc)? If not, just react (\N{HEAVY MULTIPLICATION X}) below.",
+        )
 
-            # Parse ingredient
-            amount_str, *ingredient_name = ingredient_user_message.content.split(' ')
-            if not amount_str.isdigit():
-                their_value = await commands.clean_content().convert(ctx, amount_str)
-                return await ctx.send(f"I couldn't convert `{their_value}` into an integer - please try again later.")
-            ingredient_list.append((int(amount_str), ' '.join(ingredient_name)))
+    async def setup_recipe_amount(self, session:localutils.SetupSession, channel:discord.TextChannel, *, content:str, **kwargs):
+        """
+        Handles the user giving how many items a crafting recipe makes, and saves the recipe.
+        """
 
-        # Ask how many of the item should be created
-        await ctx.send(f"How many `{item_name}` should be created from this crafting recipe?")
-        try:
-            item_create_amount_message = await self.bot.wait_for(
-                "message", timeout=120.0,
-                check=lambda m: m.author.id == ctx.author.id and m.channel.id == ctx.channel.id and m.content
-            )
-        except asyncio.TimeoutError:
-            return await ctx.send("Timed out setting up an item acquirement via crafting - please try again later.")
+        item_name = session.item_name
         try:
-            item_create_amount = int(item_create_amount_message.content)
+            item_create_amount = int(content)
         except ValueError:
-            their_value = await commands.clean_content().convert(ctx, item_create_amount_message.content)
-            return await ctx.send(f"I couldn't convert `{their_value}` into an integer - please try again later.")
+            return await self.end_setup_session(session, channel, f"I couldn't convert `{discord.utils.escape_mentions(content)}` into an integer - please try again later.")
+        if item_create_amount < 1:
+            return await self.prompt_setup_session(session, channel, f"Crafting recipes need to make at least 1 item - how many `{session.item_name}` should be created from this crafting recipe?")
 
         # Check that all the given items exist
-        db = await self.bot.database.get_connection()
-        all_items = await db("SELECT * FROM guild_items WHERE guild_id=$1", ctx.guild.id)
-        invalid_items = [i for i in ingredient_list if i[1] not in [o['item_name'] for o in all_items]]
+        ingredients = {}
+        for amount, ingredient_name in session.data['ingredients']:
+            ingredients[ingredient_name.lower()] = ingredients.get(ingredient_name.lower(), 0) + amount
+        async with self.database() as db:
+            existing_items = await db(
+                "SELECT item_name FROM guild_items WHERE guild_id=$1 AND item_name=ANY($2::TEXT[])",
+                session.guild_id, list(ingredients),
+            )
+        invalid_items = set(ingredients).difference([i['item_name'] for i in existing_items])
         if invalid_items:
-            await db.disconnect()
-            return await ctx.send(f"You gave some invalid items in your ingredients - {invalid_items!s} - please try again later.")
+            return await self.end_setup_session(session, channel, f"You gave some invalid items in your ingredients - {', '.join(f'**{i}**' for i in sorted(invalid_items))} - please try again later.")
+
+        # Make sure the recipe doesn't loop back on itself
+        catalog = await self.item_cache.get(session.guild_id)
+        recipe_graph = catalog.recipe_graph.with_recipe(item_name, item_create_amount, ingredients)
+        cycle = recipe_graph.find_cycle()
+        if cycle:
+            return await self.end_setup_session(session, channel, f"That recipe would make items that are needed to craft themselves (`{' -> '.join(cycle)}`) - please try again later.")
+
+        # Replace the recipe in one go
+        async with channel.typing():
+            async with self.database() as db:
+                async with db.transaction():
+                    await db(
+                        """INSERT INTO craftable_items (guild_id, item_name, amount_created) VALUES ($1, $2, $3)
+                        ON CONFLICT (guild_id, item_name) DO UPDATE SET amount_created=excluded.amount_created""",
+                        session.guild_id, item_name, item_create_amount,
+                    )
+                    await db("DELETE FROM craftable_item_ingredients WHERE guild_id=$1 AND item_name=$2", session.guild_id, item_name)
+                    await db(
+                        """INSERT INTO craftable_item_ingredients (guild_id, item_name, ingredient_name, amount)
+                        SELECT $1, $2, ingredient_name, amount FROM unnest($3::TEXT[], $4::INTEGER[]) AS i(ingredient_name, amount)""",
+                        session.guild_id, item_name, list(ingredients), list(ingredients.values()),
+                    )
 
-        # Add them to the database
+        # And respond
+        self.invalidate_guild_data(session.guild_id)
+        return await self.end_setup_session(session, channel, "Your crafting recipe has been added!")
+
+    @utils.command(aliases=['exporteconomy'])
+    @commands.has_permissions(manage_guild=True)
+    @commands.bot_has_permissions(attach_files=True)
+    @commands.guild_only()
+    async def exportitems(self, ctx:utils.Context, file_format:str='json'):
+        """
+        Gives you a file with all of your guild's items, acquire methods and crafting recipes.
+        """
+
+        file_format = file_format.lower()
+        if file_format not in ('json', 'toml'):
+            return await ctx.send("You can export your items as either `json` or `toml`.")
+        catalog = await self.item_cache.get(ctx.guild.id)
+        if not catalog.items:
+            return await ctx.send("Your guild doesn't have any items to export.")
+        data = localutils.EconomyFile.from_catalog(catalog).dumps(file_format)
+        file = discord.File(io.BytesIO(data.encode('utf-8')), filename=f"items-{ctx.guild.id}.{file_format}")
+        return await ctx.send(f"Exported `{len(catalog.items):,}` items and `{len(catalog.craftable_items):,}` crafting recipes.", file=file)
+
+    @utils.command(aliases=['importeconomy'])
+    @commands.has_permissions(manage_guild=True)
+    @commands.guild_only()
+    async def importitems(self, ctx:utils.Context):
+        """
+        Adds the items, acquire methods and crafting recipes from an attached JSON or TOML file to your guild.
+        """
+
+        # Get the file
+        if not ctx.message.attachments:
+            return await ctx.send(f"You need to attach a JSON or TOML file to import - you can get one with the `{ctx.clean_prefix}exportitems` command.")
+        attachment = ctx.message.attachments[0]
+        if attachment.size > 1024 * 1024:
+            return await ctx.send("That file is too big to import - it needs to be under 1MB.")
+        file_format = 'toml' if attachment.filename.lower().endswith('.toml') else 'json'
+
+        # Make sure it all makes sense before we touch the database
+        catalog = await self.item_cache.get(ctx.guild.id)
+        try:
+            economy = localutils.EconomyFile.loads(await attachment.read(), file_format)
+            economy.validate(catalog)
+        except localutils.EconomyFileError as e:
+            problems = e.problems[:10]
+            if len(e.problems) > len(problems):
+                problems.append(f"...and {len(e.problems) - len(problems):,} more.")
+            return await ctx.send("I couldn't import that file:\n" + '\n'.join(problems))
+
+        # Add it all at once
         async with ctx.typing():
-            await db(
-                """INSERT INTO craftable_items (guild_id, item_name, amount_created)
-                VALUES ($1, $2, $3)""",
-                ctx.guild.id, item_name, item_create_amount
-            )
-            for amount, ingredient_name in ingredient_list:
-                await db(
-                    """INSERT INTO craftable_item_ingredients (guild_id, item_name, ingredient_name, amount)
-                    VALUES ($1, $2, $3, $4)""",
-                    ctx.guild.id, item_name, ingredient_name, amount
-                )
+            async with self.database() as db:
+                await economy.apply(db, ctx.guild.id)
+        self.invalidate_guild_data(ctx.guild.id)
+        new_item_count = len(economy.items.difference(catalog.items))
+        return await ctx.send(f"Imported `{len(economy.items):,}` items (`{new_item_count:,}` of them new), `{len(economy.acquire_methods):,}` acquire methods, and `{len(economy.craftable_items):,}` crafting recipes.")
+
+    @utils.command(hidden=True)
+    @commands.is_owner()
+    async def itemdbstats(self, ctx:utils.Context):
+        """
+        Shows the item cog's database connection usage.
+        """
 
-        # And respond
-        await db.disconnect()
-        return await ctx.send("Your crafting recipe has been added!")
+        metrics = self.database.get_metrics()
+        return await ctx.send('\n'.join([f"`{i}`: {o if not isinstance(o, float) else f'{o:.4f}'}" for i, o in metrics.items()]))
+
+    @utils.command(hidden=True)
+    @commands.is_owner()
+    async def exportanalytics(self, ctx:utils.Context, guild_id:typing.Optional[int]=None, since:utils.TimeValue=None):
+        """
+        Exports inventories and the item event log for analytics, either for one guild or for every guild.
+        """
+
+        # Work out where it's going
+        export_config = self.bot.config.get('analytics_export', {})
+        directory = os.path.join(
+            export_config.get('directory') or 'exports',
+            f"{dt.datetime.utcnow():%Y%m%d-%H%M%S}-{guild_id or 'all'}",
+        )
+        since_datetime = dt.datetime.utcnow() - since.delta if since else None
+
+        # Stream it all out on a connection of its own, so that we're not holding one from the pool
+        async with ctx.typing():
+            connection = await asyncpg.connect(**localutils.get_export_connect_kwargs(self.bot.config))
+            try:
+                exported = await localutils.export_analytics(
+                    connection, directory, guild_id=guild_id, since=since_datetime,
+                    file_format=export_config.get('format', 'csv'),
+                    chunk_size=export_config.get('chunk_size', 64 * 1024 * 1024),
+                )
+            except ValueError as e:
+                return await ctx.send(str(e))
+            finally:
+                await connection.close()
+
+        # Tell them where it went
+        lines = [f"Exported to `{directory}`:"]
+        for name, (row_count, paths) in exported.items():
+            file_size = sum(os.path.getsize(i) for i in paths)
+            lines.append(f"`{name}`: `{row_count:,}` rows in `{len(paths):,}` files (`{file_size:,}` bytes)")
+        return await ctx.send('\n'.join(lines))
 
     @commands.command()
     @commands.guild_only()
@@ -456,69 +1351,33 @@ class ItemCommands(utils.Cog):
         """Shows the item map for your guild"""
 
         # Get the items for the guild
-        async with self.bot.database() as db:
-            acquirable_items = await db("SELECT * FROM guild_item_acquire_methods WHERE guild_id=$1", ctx.guild.id)
-            craftable_items = await db("SELECT * FROM craftable_item_ingredients WHERE guild_id=$1", ctx.guild.id)
-
-        # Let's start off our dot right
-        lines = [
-            'digraph{',
-            'overlap=scale;',
-            'node[style=filled];',
-            'bgcolour=transparent;',
-            'command[label="getitem", fillcolor=lightblue];',
-        ]
-        start_time = dt.utcnow()
-
-        # Go through each item
-        for item in acquirable_items:
-            if item['acquired_by'] == 'Command':
-                lines.append(f'command -> "{item["item_name"]}" [label="{item["min_acquired"]}-{item["max_acquired"]}x"];')
-        for item in craftable_items:
-            lines.append(f'"{item["ingredient_name"]}" -> "{item["item_name"]}" [label="{item["amount"]}x"];')
-        lines.append('}')
-        all_code = ''.join(lines)
-
-        # Write code to file
-        try:
-            with open(f'{ctx.guild.id}.gz', 'w', encoding='utf-8') as a:
-                a.write(all_code)
-        except Exception as e:
-            self.logger.error(f"Could not write to {ctx.guild.id}.gz")
-            raise e
+        catalog = await self.item_cache.get(ctx.guild.id)
+        item_map = localutils.ItemMap.from_catalog(catalog)
+        all_code = item_map.to_dot()
+        start_time = time.perf_counter()
 
         # Convert to an image
-        dot = await asyncio.create_subprocess_exec(*[
-            'neato',
-            '-Tpng',
-            f'{ctx.guild.id}.gz',
-            '-o',
-            f'{ctx.guild.id}.png',
-            '-Gcharset=UTF-8',
-        ], loop=self.bot.loop)
-        await asyncio.wait_for(dot.wait(), 10.0, loop=self.bot.loop)
-
-        # Kill subprocess
         try:
-            dot.kill()
-        except ProcessLookupError:
-            pass  # It already died
-        except Exception as e:
-            raise e
+            image_data = await self.item_map_cache.get_or_render(
+                ctx.guild.id, all_code,
+                lambda: localutils.timed_coroutine_function('render', self.item_map_renderer.render)(item_map),
+            )
+        except asyncio.TimeoutError:
+            return await ctx.send("Your item map took too long to generate - please try again later.")
+        except localutils.ItemMapTooLarge as e:
+            return await ctx.send(str(e))
+        except (RuntimeError, concurrent.futures.process.BrokenProcessPool) as e:
+            self.logger.error(f"Failed to render the item map for guild {ctx.guild.id} - {e}")
+            return await ctx.send("I couldn't render your item map - please try again later.")
 
         # Get time taken
-        end_time = dt.now()
-        time_taken = (end_time - start_time).total_seconds()
+        time_taken = time.perf_counter() - start_time
 
         # Send file
-        file = discord.File(fp=f'{ctx.guild.id}.png')
+        file = discord.File(io.BytesIO(image_data), filename=f"{ctx.guild.id}.png")
         text = f"Generated in `{time_taken:.2f}` seconds from `{len(all_code)}` bytes of DOT code, "
         await ctx.send(text, file=file)
 
-        # Delete cached
-        self.bot.loop.create_task(asyncio.create_subprocess_exec('rm', f'{ctx.guild.id}.gz', loop=self.bot.loop))
-        self.bot.loop.create_task(asyncio.create_subprocess_exec('rm', f'{ctx.guild.id}.png', loop=self.bot.loop))
-
 
 def setup(bot:utils.Bot):
     x = ItemCommands(bot)
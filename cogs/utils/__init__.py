@@ -0,0 +1,25 @@
+from cogs.utils.metrics import (
+    MetricsRegistry, MetricsExporter, Counter, Gauge, Histogram, CommandTimer,
+    current_command_timer, record_phase, timed, untimed, timed_coroutine_function,
+)
+from cogs.utils.item_database import ItemDatabase, ItemDatabaseConnection
+from cogs.utils.item_metrics import ItemMetrics
+from cogs.utils.recipe_graph import CraftingPlan, RecipeGraph
+from cogs.utils.item_cache import GuildCatalog, GuildItemCache, MessageAcquireIndex
+from cogs.utils.cooldowns import (
+    CooldownStore, MemoryCooldownStore, DatabaseCooldownStore, RedisCooldownStore,
+    get_cooldown_store,
+)
+from cogs.utils.inventory_buffer import InventoryWriteBuffer
+from cogs.utils.item_map import ItemMap, ItemMapRenderer, ItemMapTooLarge, render_item_map_png
+from cogs.utils.render_cache import RenderCache
+from cogs.utils.economy_file import EconomyFile, EconomyFileError
+from cogs.utils.item_transfers import apply_inventory_changes, exchange_items, get_transfer_changes, give_items_to_users
+from cogs.utils.item_shop import SHOP_EMOJI, ShopIndex, ShopOffer
+from cogs.utils.setup_sessions import SetupSession, SetupSessionStore
+from cogs.utils.cache_invalidation import (
+    CacheInvalidator, MemoryCacheInvalidator, PostgresCacheInvalidator, get_cache_invalidator,
+)
+from cogs.utils.item_events import ItemEventLog
+from cogs.utils.analytics_export import ChunkedExportWriter, export_analytics, get_export_connect_kwargs
+from cogs.utils.rate_limits import CommandRateLimited, CommandRateLimiter, get_command_rate_limiter
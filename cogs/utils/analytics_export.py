@@ -0,0 +1,160 @@
+import asyncio
+import datetime as dt
+import gzip
+import io
+import os
+import typing
+
+import asyncpg
+
+try:
+    import pyarrow.csv as pyarrow_csv
+    import pyarrow.parquet as pyarrow_parquet
+except ImportError:
+    pyarrow_csv, pyarrow_parquet = None, None
+
+
+EXPORT_QUERIES = {
+    "inventories": (
+        """SELECT guild_id, user_id, item_name, amount FROM user_inventories
+        WHERE $1::BIGINT IS NULL OR guild_id=$1"""
+    ),
+    "item_events": (
+        """SELECT event_id, guild_id, user_id, item_name, amount, source, created_at FROM item_events
+        WHERE ($1::BIGINT IS NULL OR guild_id=$1) AND ($2::TIMESTAMP IS NULL OR created_at >= $2)
+        ORDER BY event_id"""
+    ),
+}
+EXPORT_FORMATS = ("csv", "parquet")
+
+
+class ChunkedExportWriter(object):
+    """
+    Takes the CSV output of a `COPY ... TO STDOUT` a block at a time and splits it into files of around
+    `chunk_size` uncompressed bytes. Files are only ever split between rows, and each one starts with the
+    CSV header, so every chunk can be read on its own.
+
+    CSV chunks are gzipped as they're written. Parquet chunks are held in memory until they're full, then
+    converted, so memory use is capped at a single chunk either way.
+    """
+
+    def __init__(self, directory:str, name:str, *, file_format:str="csv", chunk_size:int=64 * 1024 * 1024):
+        if file_format not in EXPORT_FORMATS:
+            raise ValueError(f"Invalid export format {file_format!r}")
+        if file_format == "parquet" and pyarrow_parquet is None:
+            raise ValueError("Exporting to Parquet needs pyarrow to be installed")
+        self.directory = directory
+        self.name = name
+        self.file_format = file_format
+        self.chunk_size = chunk_size
+        self.paths: typing.List[str] = []
+        self._header: bytes = None
+        self._file: typing.BinaryIO = None
+        self._written = 0
+        self._quotes = 0  # How many quote characters have been written, so we know whether we're inside a quoted field
+
+    def _open(self) -> None:
+        extension = "csv.gz" if self.file_format == "csv" else "parquet"
+        path = os.path.join(self.directory, f"{self.name}-{len(self.paths):05}.{extension}")
+        self.paths.append(path)
+        if self.file_format == "csv":
+            self._file = gzip.open(path, "wb")
+        else:
+            self._file = io.BytesIO()
+        self._written = 0
+        if self._header is not None:
+            self._file.write(self._header)
+
+    def _close(self) -> None:
+        if self._file is None:
+            return
+        if self.file_format == "parquet":
+            self._file.seek(0)
+            pyarrow_parquet.write_table(pyarrow_csv.read_csv(self._file), self.paths[-1])
+        self._file.close()
+        self._file = None
+
+    def _find_row_end(self, data:bytes, start:int) -> typing.Optional[int]:
+        """
+        Gets the index just after the first row that ends at or after `start`, if one ends in this block.
+        Newlines inside quoted fields are skipped.
+        """
+
+        index = data.find(b"\n", start)
+        while index != -1:
+            if (self._quotes + data.count(b'"', 0, index)) % 2 == 0:
+                return index + 1
+            index = data.find(b"\n", index + 1)
+        return None
+
+    def write(self, data:bytes) -> None:
+        """
+        Writes a block of CSV data, starting a new file whenever the current one is full.
+        """
+
+        if self._header is None:
+            self._header = data[:data.index(b"\n") + 1]
+            data = data[len(self._header):]
+        while data:
+            if self._file is None:
+                self._open()
+            split = self._find_row_end(data, max(self.chunk_size - self._written - 1, 0))
+            if split is None:
+                split = len(data)
+            self._file.write(data[:split])
+            self._written += split
+            self._quotes += data.count(b'"', 0, split)
+            data = data[split:]
+            if self._written >= self.chunk_size:
+                self._close()
+
+    def close(self) -> None:
+        """
+        Finishes the last file. If there weren't any rows then no files are made.
+        """
+
+        self._close()
+
+
+async def export_analytics(
+        connection:asyncpg.Connection, directory:str, *, guild_id:int=None, since:dt.datetime=None,
+        file_format:str="csv", chunk_size:int=64 * 1024 * 1024) -> typing.Dict[str, typing.Tuple[int, typing.List[str]]]:
+    """
+    Streams the inventories and item event log into chunked files in the given directory, either for one guild
+    or for everything. Both are read from the same snapshot in a read only transaction, and the rows are
+    written out as they arrive, so nothing is ever held in memory past the current chunk. File writes are done
+    in a thread so that compression doesn't hold up the event loop.
+
+    Returns:
+        Dict[str, Tuple[int, List[str]]]: The number of rows exported and the files written for each table.
+    """
+
+    os.makedirs(directory, exist_ok=True)
+    loop = asyncio.get_event_loop()
+    exported = {}
+    async with connection.transaction(isolation="repeatable_read", readonly=True):
+        for name, query in EXPORT_QUERIES.items():
+            args = (guild_id,) if name == "inventories" else (guild_id, since)
+            writer = ChunkedExportWriter(directory, name, file_format=file_format, chunk_size=chunk_size)
+
+            async def write(data:bytes):
+                await loop.run_in_executor(None, writer.write, data)
+
+            try:
+                status = await connection.copy_from_query(query, *args, output=write, format="csv", header=True)
+            finally:
+                await loop.run_in_executor(None, writer.close)
+            exported[name] = (int(status.split()[-1]), writer.paths)
+    return exported
+
+
+def get_export_connect_kwargs(config:dict) -> dict:
+    """
+    Gets the arguments to connect to the database that exports are read from. This is the `dsn` in the
+    `[analytics_export]` config section if there is one (eg a read replica), otherwise the bot's database.
+    """
+
+    dsn = config.get('analytics_export', {}).get('dsn')
+    if dsn:
+        return {'dsn': dsn}
+    return {i: o for i, o in config['database'].items() if i != 'enabled'}
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import typing
+import uuid
+
+import asyncpg
+import voxelbotutils as utils
+
+from cogs.utils.item_database import ItemDatabase
+
+
+InvalidationCallback = typing.Callable[[typing.Optional[int]], None]
+
+
+class CacheInvalidator(object):
+    """
+    Tells the other processes running the bot when a guild's cached data changes. This base class
+    is for a bot running in a single process, where there's nobody else to tell.
+
+    Callbacks are given the ID of the guild that changed, or None if everything should be dropped
+    (eg after missing notifications while disconnected).
+    """
+
+    def __init__(self):
+        self.callbacks: typing.List[InvalidationCallback] = []
+
+    def add_callback(self, callback:InvalidationCallback) -> None:
+        self.callbacks.append(callback)
+
+    def dispatch(self, guild_id:typing.Optional[int]) -> None:
+        for callback in self.callbacks:
+            callback(guild_id)
+
+    async def publish(self, guild_id:int) -> None:
+        pass
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+
+class MemoryCacheInvalidator(CacheInvalidator):
+    """
+    Passes invalidations between invalidators in the same process that share a group, for running
+    several copies of the cog side by side in tests.
+    """
+
+    groups: typing.Dict[str, typing.List['MemoryCacheInvalidator']] = {}
+
+    def __init__(self, group:str='default'):
+        super().__init__()
+        self.group = group
+
+    async def publish(self, guild_id:int) -> None:
+        for invalidator in self.groups.get(self.group, []):
+            if invalidator is not self:
+                invalidator.dispatch(guild_id)
+
+    async def start(self) -> None:
+        self.groups.setdefault(self.group, []).append(self)
+
+    async def stop(self) -> None:
+        if self in self.groups.get(self.group, []):
+            self.groups[self.group].remove(self)
+
+
+class PostgresCacheInvalidator(CacheInvalidator):
+    """
+    Passes invalidations between processes with Postgres' LISTEN/NOTIFY. Listening needs a connection
+    that's held for good, so it gets its own rather than taking one from the pool. If that connection
+    drops then it's reopened, and everything is invalidated since notifications may have been missed.
+    """
+
+    def __init__(
+            self, database:ItemDatabase, connect_kwargs:dict, *, channel:str='item_cache_invalidation',
+            reconnect_delay:float=5.0, logger:logging.Logger=None):
+        super().__init__()
+        self.database = database
+        self.connect_kwargs = connect_kwargs
+        self.channel = channel
+        self.reconnect_delay = reconnect_delay
+        self.logger = logger or logging.getLogger("bot.cache_invalidation")
+        self.origin = uuid.uuid4().hex[:16]
+        self._listen_task: asyncio.Task = None
+        self._connection: asyncpg.Connection = None
+
+    async def publish(self, guild_id:int) -> None:
+        try:
+            async with self.database() as db:
+                await db("SELECT pg_notify($1, $2)", self.channel, f"{self.origin}:{guild_id}")
+        except Exception as e:
+            self.logger.error(f"Failed to publish a cache invalidation for guild {guild_id} - {e}")
+
+    def _on_notification(self, connection:asyncpg.Connection, pid:int, channel:str, payload:str) -> None:
+        origin, _, guild_id = payload.partition(':')
+        if origin == self.origin:
+            return
+        try:
+            self.dispatch(int(guild_id))
+        except ValueError:
+            self.logger.warning(f"Got an invalid cache invalidation payload {payload!r}")
+
+    async def _listen_loop(self) -> None:
+        connected_before = False
+        while True:
+            try:
+                self._connection = await asyncpg.connect(**self.connect_kwargs)
+                closed = asyncio.Event()
+                self._connection.add_termination_listener(lambda connection: closed.set())
+                await self._connection.add_listener(self.channel, self._on_notification)
+                if connected_before:
+                    self.logger.info("Reconnected to the cache invalidation channel - invalidating everything")
+                    self.dispatch(None)
+                connected_before = True
+                await closed.wait()
+                self.logger.warning("Lost the cache invalidation connection")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(f"Failed to listen for cache invalidations - {e}")
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def start(self) -> None:
+        self._listen_task = asyncio.ensure_future(self._listen_loop())
+
+    async def stop(self) -> None:
+        if self._listen_task is not None:
+            self._listen_task.cancel()
+            self._listen_task = None
+        if self._connection is not None and not self._connection.is_closed():
+            await self._connection.close()
+        self._connection = None
+
+
+def get_cache_invalidator(bot:utils.Bot, database:ItemDatabase, logger:logging.Logger=None) -> CacheInvalidator:
+    """
+    Gets the cache invalidator set up in the bot's config.
+    """
+
+    config = bot.config.get('cache_invalidation', {})
+    backend = config.get('backend', 'local')
+    if backend == 'postgres':
+        connect_kwargs = {i: o for i, o in bot.config['database'].items() if i != 'enabled'}
+        return PostgresCacheInvalidator(
+            database, connect_kwargs,
+            channel=config.get('channel', 'item_cache_invalidation'), logger=logger,
+        )
+    if backend == 'memory':
+        return MemoryCacheInvalidator(config.get('channel', 'default'))
+    if backend == 'local':
+        return CacheInvalidator()
+    raise ValueError(f"Invalid cache invalidation backend {backend!r}")
@@ -0,0 +1,157 @@
+import collections
+import time
+import typing
+
+import voxelbotutils as utils
+
+from cogs.utils.item_database import ItemDatabase
+
+
+CooldownKey = typing.Tuple[typing.Any, ...]
+
+
+class CooldownStore(object):
+    """
+    The base class for somewhere that cooldowns are stored. Each store has a single
+    atomic check-and-set method so that concurrent commands can't both get through.
+    """
+
+    def __init__(self, namespace:str):
+        self.namespace = namespace
+
+    def format_key(self, key:CooldownKey) -> str:
+        return ':'.join([self.namespace] + [str(i) for i in key])
+
+    async def try_acquire(self, key:CooldownKey, seconds:float) -> float:
+        """
+        Starts a cooldown for the given key if there isn't one running already.
+
+        Returns:
+            float: 0 if the cooldown was started, otherwise the number of seconds left on the running cooldown.
+        """
+
+        raise NotImplementedError()
+
+
+class MemoryCooldownStore(CooldownStore):
+    """
+    A cooldown store that's kept in the process. Expired cooldowns are swept out periodically and
+    the store never grows past `max_size` keys, dropping the oldest cooldowns first when it's full.
+    """
+
+    def __init__(self, namespace:str, *, max_size:int=100_000, sweep_interval:float=60.0):
+        super().__init__(namespace)
+        self.max_size = max_size
+        self.sweep_interval = sweep_interval
+        self._expiries: typing.Dict[CooldownKey, float] = collections.OrderedDict()
+        self._last_sweep = time.monotonic()
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def sweep(self, now:float=None) -> None:
+        """
+        Removes all of the expired cooldowns from the store.
+        """
+
+        now = now or time.monotonic()
+        self._expiries = collections.OrderedDict((i, o) for i, o in self._expiries.items() if o > now)
+        self._last_sweep = now
+
+    def try_acquire_nowait(self, key:CooldownKey, seconds:float) -> float:
+        """
+        The synchronous version of :func:`try_acquire`, for use on hot paths.
+        """
+
+        now = time.monotonic()
+        if now - self._last_sweep > self.sweep_interval:
+            self.sweep(now)
+        expires = self._expiries.get(key)
+        if expires is not None and expires > now:
+            return expires - now
+        self._expiries.pop(key, None)
+        self._expiries[key] = now + seconds
+        while len(self._expiries) > self.max_size:
+            self._expiries.popitem(last=False)
+        return 0
+
+    async def try_acquire(self, key:CooldownKey, seconds:float) -> float:
+        return self.try_acquire_nowait(key, seconds)
+
+
+class DatabaseCooldownStore(CooldownStore):
+    """
+    A cooldown store backed by the `item_cooldowns` table, shared between every process
+    using the same database.
+    """
+
+    def __init__(self, namespace:str, database:ItemDatabase, *, sweep_interval:float=600.0):
+        super().__init__(namespace)
+        self.database = database
+        self.sweep_interval = sweep_interval
+        self._last_sweep = time.monotonic()
+
+    async def try_acquire(self, key:CooldownKey, seconds:float) -> float:
+        sweep = time.monotonic() - self._last_sweep > self.sweep_interval
+        async with self.database() as db:
+            rows = await db(
+                """WITH acquired AS (
+                    INSERT INTO item_cooldowns (cooldown_key, expires_at)
+                    VALUES ($1, TIMEZONE('UTC', NOW()) + MAKE_INTERVAL(secs => $2))
+                    ON CONFLICT (cooldown_key) DO UPDATE SET expires_at=excluded.expires_at
+                    WHERE item_cooldowns.expires_at <= TIMEZONE('UTC', NOW())
+                    RETURNING cooldown_key
+                )
+                SELECT EXISTS(SELECT 1 FROM acquired) AS acquired,
+                (SELECT EXTRACT(EPOCH FROM expires_at - TIMEZONE('UTC', NOW())) FROM item_cooldowns WHERE cooldown_key=$1) AS remaining""",
+                self.format_key(key), float(seconds),
+            )
+            if sweep:
+                self._last_sweep = time.monotonic()
+                await db("DELETE FROM item_cooldowns WHERE expires_at < TIMEZONE('UTC', NOW())")
+        if rows[0]['acquired']:
+            return 0
+
+        # The remaining time is read from the statement's snapshot, so if a concurrent call has only just
+        # started the cooldown we won't see it - they've got it for the full length either way
+        remaining = float(rows[0]['remaining'] or 0)
+        return remaining if remaining > 0 else float(seconds)
+
+
+class RedisCooldownStore(CooldownStore):
+    """
+    A cooldown store backed by Redis keys with expiry times, shared between every process
+    using the same Redis database.
+    """
+
+    def __init__(self, namespace:str, redis:typing.Type[utils.RedisConnection]):
+        super().__init__(namespace)
+        self.redis = redis
+
+    async def try_acquire(self, key:CooldownKey, seconds:float) -> float:
+        redis_key = self.format_key(key)
+        async with self.redis() as re:
+            for _ in range(2):
+                acquired = await re.conn.set(redis_key, 1, pexpire=max(int(seconds * 1000), 1), exist=re.conn.SET_IF_NOT_EXIST)
+                if acquired:
+                    return 0
+                remaining = await re.conn.pttl(redis_key)
+                if remaining > 0:
+                    return remaining / 1000
+        return float(seconds)
+
+
+def get_cooldown_store(bot:utils.Bot, database:ItemDatabase, namespace:str) -> CooldownStore:
+    """
+    Gets the cooldown store set up in the bot's config.
+    """
+
+    config = bot.config.get('item_cooldowns', {})
+    backend = config.get('backend', 'database')
+    if backend == 'redis':
+        return RedisCooldownStore(namespace, bot.redis)
+    if backend == 'database':
+        return DatabaseCooldownStore(namespace, database)
+    if backend == 'memory':
+        return MemoryCooldownStore(namespace, max_size=config.get('max_size', 100_000))
+    raise ValueError(f"Invalid cooldown backend {backend!r}")
@@ -0,0 +1,225 @@
+import json
+import typing
+
+import toml
+
+from cogs.utils.item_cache import GuildCatalog
+from cogs.utils.item_database import ItemDatabaseConnection
+from cogs.utils.recipe_graph import RecipeGraph
+
+
+MAX_NAME_LENGTH = 200
+MAX_INTEGER = 2 ** 31 - 1
+ACQUIRE_METHOD_KEYS = {'command': 'Command', 'message': 'Message'}
+
+
+class EconomyFileError(ValueError):
+    """
+    Raised when an economy file can't be read or doesn't describe a valid economy.
+    """
+
+    def __init__(self, problems:typing.List[str]):
+        super().__init__('\n'.join(problems))
+        self.problems = problems
+
+
+class EconomyFile(object):
+    """
+    All of a guild's items, acquire methods and crafting recipes, in a form that can be written to and read
+    from a JSON or TOML file. Each item is a key under `items`, with optional `command`, `message` and
+    `crafting` tables:
+
+        [items.plank.command]
+        min_acquired = 1
+        max_acquired = 5
+        acquire_per = 3600  # seconds
+
+        [items.plank.crafting]
+        amount_created = 4
+        ingredients = { wood = 1 }
+    """
+
+    def __init__(
+            self, items:typing.Set[str], acquire_methods:typing.Dict[typing.Tuple[str, str], dict],
+            craftable_items:typing.Dict[str, int], recipes:typing.Dict[str, typing.Dict[str, int]]):
+        self.items = items  # item_name
+        self.acquire_methods = acquire_methods  # (item_name, acquired_by): {min_acquired, max_acquired, acquire_per}
+        self.craftable_items = craftable_items  # item_name: amount_created
+        self.recipes = recipes  # item_name: {ingredient_name: amount}
+
+    @classmethod
+    def from_catalog(cls, catalog:GuildCatalog) -> 'EconomyFile':
+        acquire_methods = {
+            i: {'min_acquired': o['min_acquired'], 'max_acquired': o['max_acquired'], 'acquire_per': o['acquire_per']}
+            for i, o in catalog.acquire_methods.items()
+        }
+        return cls(set(catalog.items), acquire_methods, dict(catalog.craftable_items), dict(catalog.recipes))
+
+    def to_dict(self) -> dict:
+        items = {}
+        for item_name in sorted(self.items):
+            item = {}
+            for key, acquired_by in ACQUIRE_METHOD_KEYS.items():
+                if (item_name, acquired_by) in self.acquire_methods:
+                    item[key] = dict(self.acquire_methods[(item_name, acquired_by)])
+            if item_name in self.craftable_items:
+                item['crafting'] = {
+                    'amount_created': self.craftable_items[item_name],
+                    'ingredients': dict(sorted(self.recipes.get(item_name, {}).items())),
+                }
+            items[item_name] = item
+        return {'items': items}
+
+    def dumps(self, file_format:str='json') -> str:
+        if file_format == 'toml':
+            return toml.dumps(self.to_dict())
+        return json.dumps(self.to_dict(), indent=4)
+
+    @classmethod
+    def loads(cls, data:typing.Union[str, bytes], file_format:str='json') -> 'EconomyFile':
+        """
+        Reads and checks an economy file, raising an EconomyFileError with everything that's wrong with it.
+        """
+
+        # Parse the file
+        try:
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            if file_format == 'toml':
+                parsed = toml.loads(data)
+            else:
+                parsed = json.loads(data)
+        except (UnicodeDecodeError, ValueError, toml.TomlDecodeError) as e:
+            raise EconomyFileError([f"The file couldn't be read as {file_format.upper()} - {e}"])
+        if not isinstance(parsed, dict) or not isinstance(parsed.get('items'), dict):
+            raise EconomyFileError(["The file needs an `items` table with an entry for each item."])
+
+        # Read each item
+        problems = []
+        items, acquire_methods, craftable_items, recipes = set(), {}, {}, {}
+        for raw_item_name, item in parsed['items'].items():
+            item_name = raw_item_name.strip().lower()
+            if not item_name or len(item_name) > MAX_NAME_LENGTH:
+                problems.append(f"`{raw_item_name[:50]}` isn't a valid item name.")
+                continue
+            if item_name in items:
+                problems.append(f"**{item_name}** is in the file more than once.")
+                continue
+            items.add(item_name)
+            if not isinstance(item, dict):
+                problems.append(f"**{item_name}** should be a table.")
+                continue
+            for key in set(item).difference(ACQUIRE_METHOD_KEYS, {'crafting'}):
+                problems.append(f"**{item_name}** has an unknown key `{key}`.")
+
+            # Read the acquire methods
+            for key, acquired_by in ACQUIRE_METHOD_KEYS.items():
+                if key not in item:
+                    continue
+                method = item[key]
+                if not isinstance(method, dict):
+                    problems.append(f"The {key} acquire method for **{item_name}** should be a table.")
+                    continue
+                values = {i: method.get(i) for i in ('min_acquired', 'max_acquired', 'acquire_per')}
+                invalid = [i for i, o in values.items() if not cls.is_valid_integer(o)]
+                if invalid:
+                    problems.append(f"The {key} acquire method for **{item_name}** needs whole numbers of 0 or more for {', '.join(f'`{i}`' for i in invalid)}.")
+                    continue
+                if values['min_acquired'] > values['max_acquired']:
+                    problems.append(f"The {key} acquire method for **{item_name}** has a `min_acquired` that's more than its `max_acquired`.")
+                    continue
+                acquire_methods[(item_name, acquired_by)] = values
+
+            # Read the recipe
+            if 'crafting' not in item:
+                continue
+            crafting = item['crafting']
+            if not isinstance(crafting, dict) or not isinstance(crafting.get('ingredients'), dict) or not crafting['ingredients']:
+                problems.append(f"The crafting recipe for **{item_name}** needs an `ingredients` table.")
+                continue
+            amount_created = crafting.get('amount_created', 1)
+            if not cls.is_valid_integer(amount_created, minimum=1):
+                problems.append(f"The crafting recipe for **{item_name}** needs an `amount_created` of 1 or more.")
+                continue
+            ingredients = {}
+            for ingredient_name, amount in crafting['ingredients'].items():
+                if not ingredient_name.strip() or len(ingredient_name.strip()) > MAX_NAME_LENGTH:
+                    problems.append(f"The crafting recipe for **{item_name}** has an ingredient with an invalid name.")
+                    continue
+                if not cls.is_valid_integer(amount, minimum=1):
+                    problems.append(f"The crafting recipe for **{item_name}** needs a whole number of 1 or more for **{ingredient_name}**.")
+                    continue
+                ingredients[ingredient_name.strip().lower()] = amount
+            craftable_items[item_name] = amount_created
+            recipes[item_name] = ingredients
+
+        if problems:
+            raise EconomyFileError(problems)
+        return cls(items, acquire_methods, craftable_items, recipes)
+
+    @staticmethod
+    def is_valid_integer(value:typing.Any, *, minimum:int=0) -> bool:
+        return isinstance(value, int) and not isinstance(value, bool) and minimum <= value <= MAX_INTEGER
+
+    def validate(self, catalog:GuildCatalog) -> None:
+        """
+        Checks that the file can be added to a guild's current economy - every ingredient has to be an item
+        in the file or the guild already, and the combined recipes can't loop back on themselves.
+        """
+
+        problems = []
+        known_items = self.items.union(catalog.items)
+        for item_name, ingredients in sorted(self.recipes.items()):
+            unknown = sorted(set(ingredients).difference(known_items))
+            if unknown:
+                problems.append(f"The crafting recipe for **{item_name}** uses items that don't exist - {', '.join(f'**{i}**' for i in unknown)}.")
+        recipe_graph = RecipeGraph({**catalog.craftable_items, **self.craftable_items}, {**catalog.recipes, **self.recipes})
+        cycle = recipe_graph.find_cycle()
+        if cycle:
+            problems.append(f"The crafting recipes would make items that are needed to craft themselves (`{' -> '.join(cycle)}`).")
+        if problems:
+            raise EconomyFileError(problems)
+
+    async def apply(self, db:ItemDatabaseConnection, guild_id:int) -> None:
+        """
+        Adds everything in the file to a guild in a single transaction. Items that already exist are kept,
+        and any acquire methods or recipes in the file replace the guild's current ones for those items.
+        """
+
+        acquire_keys = list(self.acquire_methods)
+        acquire_values = [self.acquire_methods[i] for i in acquire_keys]
+        ingredient_rows = [(i, ingredient_name, amount) for i, ingredients in self.recipes.items() for ingredient_name, amount in ingredients.items()]
+        async with db.transaction():
+            await db(
+                """INSERT INTO guild_items (guild_id, item_name)
+                SELECT $1, item_name FROM unnest($2::TEXT[]) AS i(item_name)
+                ON CONFLICT (guild_id, item_name) DO NOTHING""",
+                guild_id, list(self.items),
+            )
+            await db(
+                """INSERT INTO guild_item_acquire_methods (guild_id, item_name, acquired_by, min_acquired, max_acquired, acquire_per)
+                SELECT $1, item_name, acquired_by::acquire_type, min_acquired, max_acquired, acquire_per
+                FROM unnest($2::TEXT[], $3::TEXT[], $4::INTEGER[], $5::INTEGER[], $6::INTEGER[])
+                AS i(item_name, acquired_by, min_acquired, max_acquired, acquire_per)
+                ON CONFLICT (guild_id, item_name, acquired_by) DO UPDATE
+                SET min_acquired=excluded.min_acquired, max_acquired=excluded.max_acquired, acquire_per=excluded.acquire_per""",
+                guild_id, [i[0] for i in acquire_keys], [i[1] for i in acquire_keys],
+                [i['min_acquired'] for i in acquire_values], [i['max_acquired'] for i in acquire_values],
+                [i['acquire_per'] for i in acquire_values],
+            )
+            await db(
+                "DELETE FROM craftable_item_ingredients WHERE guild_id=$1 AND item_name=ANY($2::TEXT[])",
+                guild_id, list(self.craftable_items),
+            )
+            await db(
+                """INSERT INTO craftable_items (guild_id, item_name, amount_created)
+                SELECT $1, item_name, amount_created FROM unnest($2::TEXT[], $3::INTEGER[]) AS i(item_name, amount_created)
+                ON CONFLICT (guild_id, item_name) DO UPDATE SET amount_created=excluded.amount_created""",
+                guild_id, list(self.craftable_items), list(self.craftable_items.values()),
+            )
+            await db(
+                """INSERT INTO craftable_item_ingredients (guild_id, item_name, ingredient_name, amount)
+                SELECT $1, item_name, ingredient_name, amount FROM unnest($2::TEXT[], $3::TEXT[], $4::INTEGER[])
+                AS i(item_name, ingredient_name, amount)""",
+                guild_id, [i[0] for i in ingredient_rows], [i[1] for i in ingredient_rows], [i[2] for i in ingredient_rows],
+            )
@@ -0,0 +1,126 @@
+import asyncio
+import collections
+import logging
+import typing
+
+from cogs.utils.item_database import ItemDatabase
+
+
+class InventoryWriteBuffer(object):
+    """
+    Collects inventory increments in memory and writes them to the database in batches. Increments
+    for the same user and item are merged together, so a flush is a single multi-row upsert no matter
+    how many commands were run since the last one.
+    """
+
+    def __init__(
+            self, database:ItemDatabase, *, flush_interval:float=2.0, max_pending:int=10_000,
+            logger:logging.Logger=None):
+        self.database = database
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.logger = logger or logging.getLogger("bot.inventory_buffer")
+        self._pending: typing.Dict[typing.Tuple[int, int], typing.Dict[str, int]] = {}  # (guild_id, user_id): {item_name: amount}
+        self._pending_count = 0
+        self._writing: typing.Dict[typing.Tuple[int, int], asyncio.Task] = {}  # (guild_id, user_id): the write that's taken their increments
+        self._task: asyncio.Task = None
+        self._early_flush: asyncio.Task = None
+
+    def __len__(self):
+        return self._pending_count
+
+    def add(self, guild_id:int, user_id:int, item_name:str, amount:int) -> None:
+        """
+        Adds an increment to be written on the next flush.
+        """
+
+        user_pending = self._pending.setdefault((guild_id, user_id), collections.defaultdict(int))
+        if item_name not in user_pending:
+            self._pending_count += 1
+        user_pending[item_name] += amount
+        if self._pending_count >= self.max_pending and (self._early_flush is None or self._early_flush.done()):
+            self._early_flush = asyncio.ensure_future(self.flush())
+
+    async def flush(self, guild_id:int=None, user_id:int=None) -> None:
+        """
+        Writes pending increments to the database - either all of them, or just the ones for a given user.
+        A flush for a given user also waits for any other flush that's already writing their increments, so
+        everything they've been given is in the database by the time it returns.
+        """
+
+        # Wait for anything already being written for the user - if it fails, its increments are put back
+        # in the buffer and written below
+        if guild_id is not None:
+            while (guild_id, user_id) in self._writing:
+                try:
+                    await asyncio.shield(self._writing[(guild_id, user_id)])
+                except Exception:
+                    pass
+
+        # Take the increments out of the buffer
+        if guild_id is not None:
+            user_pending = self._pending.pop((guild_id, user_id), None)
+            taken = {(guild_id, user_id): user_pending} if user_pending else {}
+        else:
+            taken, self._pending = self._pending, {}
+        if not taken:
+            return
+        rows = sorted((g, u, i, a) for (g, u), items in taken.items() for i, a in items.items())
+        self._pending_count -= len(rows)
+
+        # And write them in a task of their own, so that per-user flushes can wait on it too
+        task = asyncio.ensure_future(self._write(rows, list(taken)))
+        for key in taken:
+            self._writing[key] = task
+        await asyncio.shield(task)
+
+    async def _write(self, rows:typing.List[typing.Tuple[int, int, str, int]], keys:typing.List[typing.Tuple[int, int]]) -> None:
+        """
+        Upserts a set of increments, in the same order that transfers lock rows in.
+        """
+
+        try:
+            async with self.database() as db:
+                await db(
+                    """INSERT INTO user_inventories (guild_id, user_id, item_name, amount)
+                    SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[], $3::TEXT[], $4::INTEGER[])
+                    ON CONFLICT (guild_id, user_id, item_name)
+                    DO UPDATE SET amount=user_inventories.amount+excluded.amount""",
+                    *[list(i) for i in zip(*rows)],
+                )
+        except Exception:
+            self.logger.error(f"Failed to flush {len(rows)} inventory increments - putting them back in the buffer")
+            for row in rows:
+                self.add(*row)
+            raise
+        finally:
+            task = asyncio.current_task()
+            for key in keys:
+                if self._writing.get(key) is task:
+                    del self._writing[key]
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                self.logger.error(f"Error flushing inventory buffer - {e}")
+
+    def start(self) -> None:
+        """
+        Starts flushing the buffer on an interval.
+        """
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._flush_loop())
+
+    async def close(self) -> None:
+        """
+        Stops the flush loop and writes everything that's left.
+        """
+
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
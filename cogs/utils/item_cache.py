@@ -0,0 +1,188 @@
+import asyncio
+import collections
+import typing
+
+from cogs.utils.item_database import ItemDatabase, ItemDatabaseConnection
+from cogs.utils.recipe_graph import RecipeGraph
+
+
+class GuildCatalog(object):
+    """
+    A snapshot of the item tables for a single guild - the items that exist, how they're
+    acquired, and the crafting recipes that make them.
+    """
+
+    __slots__ = ('guild_id', 'items', 'acquire_methods', 'craftable_items', 'recipes', '_recipe_graph',)
+
+    def __init__(
+            self, guild_id:int, items:typing.Set[str], acquire_methods:typing.Dict[typing.Tuple[str, str], dict],
+            craftable_items:typing.Dict[str, int], recipes:typing.Dict[str, typing.Dict[str, int]]):
+        self.guild_id = guild_id
+        self.items = items  # item_name
+        self.acquire_methods = acquire_methods  # (item_name, acquired_by): row
+        self.craftable_items = craftable_items  # item_name: amount_created
+        self.recipes = recipes  # item_name: {ingredient_name: amount}
+        self._recipe_graph = None
+
+    @property
+    def recipe_graph(self) -> RecipeGraph:
+        """
+        The guild's recipes as a graph, built the first time it's needed.
+        """
+
+        if self._recipe_graph is None:
+            self._recipe_graph = RecipeGraph(self.craftable_items, self.recipes)
+        return self._recipe_graph
+
+    @classmethod
+    async def fetch(cls, db:ItemDatabaseConnection, guild_id:int) -> 'GuildCatalog':
+        """
+        Reads the catalog for a guild from the database.
+        """
+
+        item_rows = await db("SELECT item_name FROM guild_items WHERE guild_id=$1", guild_id)
+        acquire_rows = await db("SELECT * FROM guild_item_acquire_methods WHERE guild_id=$1", guild_id)
+        craftable_rows = await db("SELECT item_name, amount_created FROM craftable_items WHERE guild_id=$1", guild_id)
+        ingredient_rows = await db("SELECT item_name, ingredient_name, amount FROM craftable_item_ingredients WHERE guild_id=$1", guild_id)
+        recipes = collections.defaultdict(dict)
+        for row in ingredient_rows:
+            recipes[row['item_name']][row['ingredient_name']] = row['amount']
+        return cls(
+            guild_id,
+            items={i['item_name'] for i in item_rows},
+            acquire_methods={(i['item_name'], i['acquired_by']): i for i in acquire_rows},
+            craftable_items={i['item_name']: i['amount_created'] for i in craftable_rows},
+            recipes=dict(recipes),
+        )
+
+
+class GuildItemCache(object):
+    """
+    A size-bounded LRU cache of guild catalogs, loaded lazily from the database.
+    """
+
+    def __init__(self, database:ItemDatabase, *, max_size:int=1000):
+        self.database = database
+        self.max_size = max_size
+        self._catalogs: typing.Dict[int, GuildCatalog] = collections.OrderedDict()
+        self._loading: typing.Dict[int, asyncio.Future] = {}
+
+    def __len__(self):
+        return len(self._catalogs)
+
+    async def get(self, guild_id:int) -> GuildCatalog:
+        """
+        Gets the catalog for a guild, loading it from the database if it isn't cached. Concurrent
+        calls for the same guild share a single load.
+        """
+
+        try:
+            catalog = self._catalogs[guild_id]
+            self._catalogs.move_to_end(guild_id)
+            return catalog
+        except KeyError:
+            pass
+        future = self._loading.get(guild_id)
+        if future is None:
+            future = asyncio.ensure_future(self._load(guild_id))
+            self._loading[guild_id] = future
+            future.add_done_callback(lambda f: self._store(guild_id, f))
+        return await asyncio.shield(future)
+
+    async def _load(self, guild_id:int) -> GuildCatalog:
+        async with self.database() as db:
+            return await GuildCatalog.fetch(db, guild_id)
+
+    def _store(self, guild_id:int, future:asyncio.Future) -> None:
+        """
+        Caches a finished load, so long as the guild wasn't invalidated while it was running.
+        """
+
+        if self._loading.get(guild_id) is not future:
+            return
+        del self._loading[guild_id]
+        if future.cancelled() or future.exception() is not None:
+            return
+        self._catalogs[guild_id] = future.result()
+        while len(self._catalogs) > self.max_size:
+            self._catalogs.popitem(last=False)
+
+    def invalidate(self, guild_id:int) -> None:
+        """
+        Drops the cached catalog for a guild so that the next read goes to the database.
+        """
+
+        self._catalogs.pop(guild_id, None)
+        self._loading.pop(guild_id, None)
+
+    def clear(self) -> None:
+        """
+        Drops every cached catalog.
+        """
+
+        self._catalogs.clear()
+        self._loading.clear()
+
+
+class MessageAcquireIndex(object):
+    """
+    Every guild's message acquire methods, kept in memory for good rather than in the LRU catalog cache, so
+    that handling a message never waits on the database. Guilds without any message acquire methods take
+    up no space.
+
+    The whole index is loaded at startup, and single guilds are reloaded when they change. Each reload is
+    numbered so that a slow one can't overwrite the results of a newer one.
+    """
+
+    def __init__(self, database:ItemDatabase):
+        self.database = database
+        self._methods: typing.Dict[int, typing.Tuple[dict, ...]] = {}
+        self._versions: typing.Dict[int, int] = {}  # guild_id: the latest reload of just that guild since the last full reload
+        self._reload_count = 0
+
+    def __len__(self):
+        return len(self._methods)
+
+    def get(self, guild_id:int) -> typing.Tuple[dict, ...]:
+        """
+        Gets the message acquire methods for a guild.
+        """
+
+        return self._methods.get(guild_id, ())
+
+    async def reload(self, guild_id:int=None, *, shard_count:int=None, shard_ids:typing.List[int]=None) -> None:
+        """
+        Reloads the message acquire methods for a single guild, or for every guild on the given shards.
+        """
+
+        self._reload_count += 1
+        reload_id = self._reload_count
+        if guild_id is not None:
+            self._versions[guild_id] = reload_id
+        async with self.database() as db:
+            rows = await db(
+                """SELECT guild_id, item_name, min_acquired, max_acquired, acquire_per FROM guild_item_acquire_methods
+                WHERE acquired_by='Message' AND ($1::BIGINT IS NULL OR guild_id=$1)
+                AND ($2::INTEGER IS NULL OR (guild_id >> 22) % $2 = ANY($3::INTEGER[]))""",
+                guild_id, shard_count, shard_ids or [],
+            )
+        methods = collections.defaultdict(list)
+        for row in rows:
+            methods[row['guild_id']].append(dict(row))
+
+        # Store a single guild if nothing newer has been asked for
+        if guild_id is not None:
+            if self._versions.get(guild_id) != reload_id:
+                return
+            if methods:
+                self._methods[guild_id] = tuple(methods[guild_id])
+            else:
+                self._methods.pop(guild_id, None)
+            return
+
+        # Replace everything, apart from guilds that have been reloaded since we started
+        newer = {i for i, o in self._versions.items() if o > reload_id}
+        new_methods = {i: tuple(o) for i, o in methods.items() if i not in newer}
+        new_methods.update({i: self._methods[i] for i in newer if i in self._methods})
+        self._methods = new_methods
+        self._versions = {i: o for i, o in self._versions.items() if o > reload_id}
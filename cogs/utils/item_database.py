@@ -0,0 +1,170 @@
+import asyncio
+import contextlib
+import logging
+import time
+import typing
+
+import asyncpg
+import voxelbotutils as utils
+
+from cogs.utils.metrics import record_phase
+
+
+QUERY_TIMEOUT = object()  # Stands in for the configured query timeout, so that None can mean no timeout at all
+
+
+class ItemDatabaseConnection(object):
+    """
+    A connection acquired through :class:`ItemDatabase`. Calling it runs a query with the configured timeout
+    and returns the rows.
+
+    Queries go through asyncpg's per-connection statement cache, so a query that's always run with the same
+    SQL text (rather than formatting values into it) is only prepared once per pooled connection.
+    """
+
+    __slots__ = ('database', 'conn',)
+
+    def __init__(self, database:'ItemDatabase', conn:asyncpg.Connection):
+        self.database = database
+        self.conn = conn
+
+    async def __call__(self, sql:str, *args, timeout:typing.Optional[float]=QUERY_TIMEOUT) -> typing.List[asyncpg.Record]:
+        """
+        Runs a query and returns its rows. The timeout is the configured query timeout unless one's given -
+        pass None to wait for as long as the query takes.
+        """
+
+        if timeout is QUERY_TIMEOUT:
+            timeout = self.database.query_timeout
+        start_time = time.perf_counter()
+        try:
+            return await self.conn.fetch(sql, *args, timeout=timeout)
+        except asyncio.TimeoutError:
+            self.database.query_timeouts += 1
+            raise
+        finally:
+            self._record_query(start_time)
+
+    def _record_query(self, start_time:float) -> None:
+        query_time = time.perf_counter() - start_time
+        self.database.query_count += 1
+        self.database.query_time += query_time
+        record_phase('database', query_time)
+
+    async def _run_transaction_statement(self, statement:typing.Callable[[], typing.Awaitable[None]]) -> None:
+        start_time = time.perf_counter()
+        try:
+            await statement()
+        finally:
+            self._record_query(start_time)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """
+        Runs the contained queries in a transaction, rolling back if an error is raised (including if the
+        task's cancelled). The BEGIN and the COMMIT or ROLLBACK are round trips of their own, so they're
+        counted and timed as queries.
+        """
+
+        transaction = self.conn.transaction()
+        await self._run_transaction_statement(transaction.start)
+        try:
+            yield self
+        except BaseException:
+            await self._run_transaction_statement(transaction.rollback)
+            raise
+        else:
+            await self._run_transaction_statement(transaction.commit)
+
+
+class ItemDatabase(object):
+    """
+    The single way that the item cog talks to the database. Connections are only ever acquired as
+    async context managers, so they're always given back to the pool, and acquisitions are counted
+    so the pool can be sized from real numbers.
+    """
+
+    def __init__(
+            self, database:typing.Type[utils.DatabaseConnection], *, query_timeout:float=10.0,
+            acquire_timeout:float=10.0, leak_threshold:float=30.0, logger:logging.Logger=None):
+        self.database = database
+        self.query_timeout = query_timeout
+        self.acquire_timeout = acquire_timeout
+        self.leak_threshold = leak_threshold
+        self.logger = logger or logging.getLogger("bot.item_database")
+        self._held_since: typing.Dict[int, float] = {}  # id(connection): time acquired
+
+        # Metrics
+        self.acquire_count = 0
+        self.acquire_timeouts = 0
+        self.acquire_wait_time = 0.0
+        self.max_acquire_wait_time = 0.0
+        self.long_held_count = 0
+        self.query_count = 0
+        self.query_timeouts = 0
+        self.query_time = 0.0
+
+    def __call__(self) -> typing.AsyncContextManager[ItemDatabaseConnection]:
+        return self.acquire()
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        """
+        Acquires a connection from the pool for the duration of the block.
+        """
+
+        start_time = time.perf_counter()
+        try:
+            conn = await asyncio.wait_for(self.database.pool.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.acquire_timeouts += 1
+            raise
+        acquired_time = time.perf_counter()
+        wait_time = acquired_time - start_time
+        record_phase('database', wait_time)
+        self.acquire_count += 1
+        self.acquire_wait_time += wait_time
+        self.max_acquire_wait_time = max(self.max_acquire_wait_time, wait_time)
+        self._held_since[id(conn)] = acquired_time
+        try:
+            yield ItemDatabaseConnection(self, conn)
+        finally:
+            del self._held_since[id(conn)]
+            held_time = time.perf_counter() - acquired_time
+            if held_time > self.leak_threshold:
+                self.long_held_count += 1
+                self.logger.warning(f"Database connection was held for {held_time:.2f} seconds")
+            await self.database.pool.release(conn)
+
+    @property
+    def in_use(self) -> int:
+        return len(self._held_since)
+
+    @property
+    def leaks_detected(self) -> int:
+        """
+        The number of connections that have been held past the leak threshold, including ones that are still out.
+        """
+
+        now = time.perf_counter()
+        return self.long_held_count + len([i for i in self._held_since.values() if now - i > self.leak_threshold])
+
+    def get_metrics(self) -> typing.Dict[str, typing.Union[int, float]]:
+        """
+        Gets the current connection and query metrics.
+        """
+
+        pool = self.database.pool
+        return {
+            "pool_size": pool.get_size() if hasattr(pool, "get_size") else None,
+            "pool_idle": pool.get_idle_size() if hasattr(pool, "get_idle_size") else None,
+            "in_use": self.in_use,
+            "acquire_count": self.acquire_count,
+            "acquire_timeouts": self.acquire_timeouts,
+            "acquire_wait_time_average": self.acquire_wait_time / self.acquire_count if self.acquire_count else 0.0,
+            "acquire_wait_time_max": self.max_acquire_wait_time,
+            "leaks_detected": self.leaks_detected,
+            "query_count": self.query_count,
+            "query_timeouts": self.query_timeouts,
+            "query_time_average": self.query_time / self.query_count if self.query_count else 0.0,
+        }
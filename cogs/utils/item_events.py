@@ -0,0 +1,98 @@
+import asyncio
+import datetime as dt
+import logging
+import typing
+
+from cogs.utils.item_database import ItemDatabase
+
+
+ItemEvent = typing.Tuple[int, int, str, int, str, dt.datetime]  # guild_id, user_id, item_name, amount, source, created_at
+
+
+class ItemEventLog(object):
+    """
+    Appends to the `item_events` table, which records every item that's created or used up (but not ones
+    that are just moved between users) so the economy can be analysed without reading the live inventories.
+    Events are collected in memory and inserted in batches, so logging never adds a query to a command -
+    they keep the time they were added rather than the time they were written.
+    """
+
+    def __init__(
+            self, database:ItemDatabase, *, enabled:bool=True, flush_interval:float=5.0, max_pending:int=10_000,
+            logger:logging.Logger=None):
+        self.database = database
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.logger = logger or logging.getLogger("bot.item_events")
+        self._pending: typing.List[ItemEvent] = []
+        self._task: asyncio.Task = None
+        self._early_flush: asyncio.Task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, guild_id:int, user_id:int, item_name:str, amount:int, source:str) -> None:
+        """
+        Logs an amount of an item being added to (or, if negative, taken from) a user's inventory.
+        """
+
+        if not self.enabled or not amount:
+            return
+        self._pending.append((guild_id, user_id, item_name, amount, source, dt.datetime.utcnow()))
+        if len(self._pending) >= self.max_pending and (self._early_flush is None or self._early_flush.done()):
+            self._early_flush = asyncio.ensure_future(self.flush())
+
+    def add_changes(self, guild_id:int, changes:typing.Dict[typing.Tuple[int, str], int], source:str) -> None:
+        """
+        Logs a set of inventory changes, as given to :func:`apply_inventory_changes`.
+        """
+
+        for (user_id, item_name), amount in changes.items():
+            self.add(guild_id, user_id, item_name, amount, source)
+
+    async def flush(self) -> None:
+        """
+        Writes every pending event to the database.
+        """
+
+        taken, self._pending = self._pending, []
+        if not taken:
+            return
+        try:
+            async with self.database() as db:
+                await db(
+                    """INSERT INTO item_events (guild_id, user_id, item_name, amount, source, created_at)
+                    SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[], $3::TEXT[], $4::INTEGER[], $5::TEXT[], $6::TIMESTAMP[])""",
+                    *[list(i) for i in zip(*taken)],
+                )
+        except Exception:
+            self.logger.error(f"Failed to write {len(taken)} item events - putting them back in the log")
+            self._pending[:0] = taken
+            raise
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                self.logger.error(f"Error flushing item event log - {e}")
+
+    def start(self) -> None:
+        """
+        Starts flushing the log on an interval.
+        """
+
+        if self.enabled and self._task is None:
+            self._task = asyncio.ensure_future(self._flush_loop())
+
+    async def close(self) -> None:
+        """
+        Stops the flush loop and writes everything that's left.
+        """
+
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
@@ -0,0 +1,314 @@
+import asyncio
+import collections
+import concurrent.futures
+import multiprocessing
+import shutil
+import struct
+import typing
+import zlib
+
+from cogs.utils.item_cache import GuildCatalog
+
+
+COMMAND_NODE = "command"
+
+# The biggest map that's drawn without Graphviz, since drawing in Python gets slow quickly
+MAX_FALLBACK_NODES = 150
+MAX_CANVAS_WIDTH = 10_000
+MAX_CANVAS_HEIGHT = 10_000
+MAX_CANVAS_PIXELS = 12_000_000
+
+
+class ItemMapTooLarge(ValueError):
+    """
+    Raised when an item map is too big to be drawn without Graphviz.
+    """
+
+
+class ItemMap(object):
+    """
+    The graph of how items in a guild are acquired - an edge goes from the `getitem` command to each
+    item it gives out, and from each ingredient to the items it's crafted into.
+    """
+
+    def __init__(self, edges:typing.List[typing.Tuple[str, str, str]]):
+        self.edges = edges  # (source, target, label)
+
+    @classmethod
+    def from_catalog(cls, catalog:GuildCatalog) -> 'ItemMap':
+        edges = []
+        for item in catalog.acquire_methods.values():
+            if item['acquired_by'] == 'Command':
+                edges.append((COMMAND_NODE, item['item_name'], f"{item['min_acquired']}-{item['max_acquired']}x"))
+        for item_name, ingredients in catalog.recipes.items():
+            for ingredient_name, amount in ingredients.items():
+                edges.append((ingredient_name, item_name, f"{amount}x"))
+        return cls(edges)
+
+    @property
+    def nodes(self) -> typing.List[str]:
+        nodes = {COMMAND_NODE: None}
+        for source, target, _ in self.edges:
+            nodes.setdefault(source, None)
+            nodes.setdefault(target, None)
+        return list(nodes)
+
+    @staticmethod
+    def _quote(name:str) -> str:
+        return '"' + name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+    def to_dot(self) -> str:
+        """
+        Gets the DOT source for the map.
+        """
+
+        lines = [
+            'digraph{',
+            'overlap=scale;',
+            'node[style=filled];',
+            'bgcolour=transparent;',
+            f'{COMMAND_NODE}[label="getitem", fillcolor=lightblue];',
+        ]
+        for source, target, label in self.edges:
+            source = COMMAND_NODE if source == COMMAND_NODE else self._quote(source)
+            lines.append(f'{source} -> {self._quote(target)} [label={self._quote(label)}];')
+        lines.append('}')
+        return ''.join(lines)
+
+
+class ItemMapRenderer(object):
+    """
+    Renders item maps to PNG bytes. Graphviz is used when it's installed, with the DOT going in through
+    stdin and the image coming back through stdout; otherwise the map is drawn by :func:`render_item_map_png`
+    in a pool of worker processes (`workers` of them, defaulting to one per render slot).
+
+    A render keeps its slot until it's actually finished, even if the caller has stopped waiting for it,
+    so renders that run past the timeout can't pile up.
+    """
+
+    def __init__(self, *, layout:str='neato', max_concurrent:int=2, timeout:float=10.0, workers:int=0):
+        self.graphviz_path = shutil.which(layout)
+        self.timeout = timeout
+        self.workers = workers or max_concurrent
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+
+        # Drawing without Graphviz is pure Python, so it's given its own processes to run in - they're
+        # only started when the first map is drawn
+        self.executor = None
+        if not self.graphviz_path:
+            self.executor = self._create_executor()
+
+    def _create_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    async def render(self, item_map:ItemMap) -> bytes:
+        """
+        Renders the given map, waiting for a free render slot first.
+
+        Raises:
+            asyncio.TimeoutError: If the render took longer than the timeout.
+            ItemMapTooLarge: If the map is too big to draw without Graphviz.
+        """
+
+        if self.graphviz_path:
+            async with self._semaphore:
+                return await self.render_graphviz(item_map.to_dot())
+        if len(item_map.nodes) > MAX_FALLBACK_NODES:
+            raise ItemMapTooLarge(f"Item maps with more than {MAX_FALLBACK_NODES} items can't be drawn right now.")
+
+        # A worker can't be stopped part way through a map, so the slot is given back when it's done rather than when we stop waiting
+        await self._semaphore.acquire()
+        try:
+            future = asyncio.get_event_loop().run_in_executor(self.executor, render_item_map_png, item_map)
+        except concurrent.futures.process.BrokenProcessPool:
+            self._semaphore.release()
+            self.executor = self._create_executor()
+            raise
+        future.add_done_callback(self._release_render_slot)
+        return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+
+    def _release_render_slot(self, future:asyncio.Future) -> None:
+        self._semaphore.release()
+        if not future.cancelled() and isinstance(future.exception(), concurrent.futures.process.BrokenProcessPool):
+            self.close()
+            self.executor = self._create_executor()
+
+    async def render_graphviz(self, dot_source:str) -> bytes:
+        process = await asyncio.create_subprocess_exec(
+            self.graphviz_path, '-Tpng', '-Gcharset=UTF-8',
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(dot_source.encode('utf-8')), self.timeout)
+        except asyncio.TimeoutError:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass  # It already died
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            raise RuntimeError(f"Graphviz exited with code {process.returncode} - {stderr.decode('utf-8', 'replace').strip()}")
+        return stdout
+
+
+# A 5x7 font for the characters that show up in item names - each character is five columns,
+# with the lowest bit being the top row
+FONT = {
+    ' ': (0x00, 0x00, 0x00, 0x00, 0x00), '-': (0x08, 0x08, 0x08, 0x08, 0x08), '_': (0x40, 0x40, 0x40, 0x40, 0x40),
+    '.': (0x00, 0x60, 0x60, 0x00, 0x00), "'": (0x00, 0x00, 0x07, 0x00, 0x00), '?': (0x02, 0x01, 0x51, 0x09, 0x06),
+    '0': (0x3E, 0x51, 0x49, 0x45, 0x3E), '1': (0x00, 0x42, 0x7F, 0x40, 0x00), '2': (0x42, 0x61, 0x51, 0x49, 0x46),
+    '3': (0x21, 0x41, 0x45, 0x4B, 0x31), '4': (0x18, 0x14, 0x12, 0x7F, 0x10), '5': (0x27, 0x45, 0x45, 0x45, 0x39),
+    '6': (0x3C, 0x4A, 0x49, 0x49, 0x30), '7': (0x01, 0x71, 0x09, 0x05, 0x03), '8': (0x36, 0x49, 0x49, 0x49, 0x36),
+    '9': (0x06, 0x49, 0x49, 0x29, 0x1E), 'a': (0x20, 0x54, 0x54, 0x54, 0x78), 'b': (0x7F, 0x48, 0x44, 0x44, 0x38),
+    'c': (0x38, 0x44, 0x44, 0x44, 0x20), 'd': (0x38, 0x44, 0x44, 0x48, 0x7F), 'e': (0x38, 0x54, 0x54, 0x54, 0x18),
+    'f': (0x08, 0x7E, 0x09, 0x01, 0x02), 'g': (0x0C, 0x52, 0x52, 0x52, 0x3E), 'h': (0x7F, 0x08, 0x04, 0x04, 0x78),
+    'i': (0x00, 0x44, 0x7D, 0x40, 0x00), 'j': (0x20, 0x40, 0x44, 0x3D, 0x00), 'k': (0x7F, 0x10, 0x28, 0x44, 0x00),
+    'l': (0x00, 0x41, 0x7F, 0x40, 0x00), 'm': (0x7C, 0x04, 0x18, 0x04, 0x78), 'n': (0x7C, 0x08, 0x04, 0x04, 0x78),
+    'o': (0x38, 0x44, 0x44, 0x44, 0x38), 'p': (0x7C, 0x14, 0x14, 0x14, 0x08), 'q': (0x08, 0x14, 0x14, 0x18, 0x7C),
+    'r': (0x7C, 0x08, 0x04, 0x04, 0x08), 's': (0x48, 0x54, 0x54, 0x54, 0x20), 't': (0x04, 0x3F, 0x44, 0x40, 0x20),
+    'u': (0x3C, 0x40, 0x40, 0x20, 0x7C), 'v': (0x1C, 0x20, 0x40, 0x20, 0x1C), 'w': (0x3C, 0x40, 0x30, 0x40, 0x3C),
+    'x': (0x44, 0x28, 0x10, 0x28, 0x44), 'y': (0x0C, 0x50, 0x50, 0x50, 0x3C), 'z': (0x44, 0x64, 0x54, 0x4C, 0x44),
+}
+
+WHITE = (255, 255, 255)
+BLACK = (0, 0, 0)
+GREY = (211, 211, 211)
+LIGHT_BLUE = (173, 216, 230)
+TEXT_SCALE = 2
+CHAR_WIDTH = 6 * TEXT_SCALE
+CHAR_HEIGHT = 7 * TEXT_SCALE
+NODE_PADDING = 8
+COLUMN_GAP = 120
+ROW_GAP = 30
+
+
+class _Canvas(object):
+
+    def __init__(self, width:int, height:int):
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(WHITE * (width * height))
+
+    def set(self, x:int, y:int, colour:typing.Tuple[int, int, int]) -> None:
+        if 0 <= x < self.width and 0 <= y < self.height:
+            index = (y * self.width + x) * 3
+            self.pixels[index:index + 3] = bytes(colour)
+
+    def rectangle(self, x0:int, y0:int, x1:int, y1:int, fill, outline=BLACK) -> None:
+        row = bytes(fill) * (x1 - x0)
+        for y in range(max(y0, 0), min(y1, self.height)):
+            index = (y * self.width + x0) * 3
+            self.pixels[index:index + len(row)] = row
+        self.line(x0, y0, x1 - 1, y0, outline)
+        self.line(x0, y1 - 1, x1 - 1, y1 - 1, outline)
+        self.line(x0, y0, x0, y1 - 1, outline)
+        self.line(x1 - 1, y0, x1 - 1, y1 - 1, outline)
+
+    def line(self, x0:int, y0:int, x1:int, y1:int, colour) -> None:
+        dx, dy = abs(x1 - x0), -abs(y1 - y0)
+        sx, sy = (1 if x0 < x1 else -1), (1 if y0 < y1 else -1)
+        error = dx + dy
+        while True:
+            self.set(x0, y0, colour)
+            if x0 == x1 and y0 == y1:
+                return
+            doubled = 2 * error
+            if doubled >= dy:
+                error += dy
+                x0 += sx
+            if doubled <= dx:
+                error += dx
+                y0 += sy
+
+    def text(self, x:int, y:int, text:str, colour=BLACK) -> None:
+        for character in text:
+            for column, bits in enumerate(FONT.get(character, FONT['?'])):
+                for row in range(7):
+                    if bits & (1 << row):
+                        for sx in range(TEXT_SCALE):
+                            for sy in range(TEXT_SCALE):
+                                self.set(x + column * TEXT_SCALE + sx, y + row * TEXT_SCALE + sy, colour)
+            x += CHAR_WIDTH
+
+    def to_png(self) -> bytes:
+        def chunk(chunk_type:bytes, data:bytes) -> bytes:
+            return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data) & 0xFFFFFFFF)
+        stride = self.width * 3
+        raw = b''.join(b'\x00' + bytes(self.pixels[y * stride:(y + 1) * stride]) for y in range(self.height))
+        return b''.join((
+            b'\x89PNG\r\n\x1a\n',
+            chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 2, 0, 0, 0)),
+            chunk(b'IDAT', zlib.compress(raw, 6)),
+            chunk(b'IEND', b''),
+        ))
+
+
+def render_item_map_png(item_map:ItemMap) -> bytes:
+    """
+    Draws an item map to a PNG without needing Graphviz. Items are laid out in columns by how many
+    steps they are from something with no ingredients, so everything flows left to right.
+
+    Raises:
+        ItemMapTooLarge: If the image would be bigger than the maximum canvas size.
+    """
+
+    # Work out which column each node goes in - capped at the node count so cycles can't loop forever
+    nodes = item_map.nodes
+    sources = collections.defaultdict(list)
+    for source, target, _ in item_map.edges:
+        sources[target].append(source)
+    depth = {i: 0 for i in nodes}
+    for _ in range(len(nodes)):
+        changed = False
+        for target, node_sources in sources.items():
+            new_depth = min(max(depth[i] for i in node_sources) + 1, len(nodes))
+            if new_depth > depth[target]:
+                depth[target] = new_depth
+                changed = True
+        if not changed:
+            break
+    columns = collections.defaultdict(list)
+    for node in nodes:
+        columns[depth[node]].append(node)
+
+    # Position each node
+    labels = {i: ("getitem" if i == COMMAND_NODE else i.lower()) for i in nodes}
+    node_height = CHAR_HEIGHT + NODE_PADDING * 2
+    positions = {}  # node: (x0, y0, x1, y1)
+    x = COLUMN_GAP // 2
+    for column_index in sorted(columns):
+        column = columns[column_index]
+        column_width = max(len(labels[i]) for i in column) * CHAR_WIDTH + NODE_PADDING * 2
+        for row_index, node in enumerate(column):
+            y = ROW_GAP + row_index * (node_height + ROW_GAP)
+            positions[node] = (x, y, x + column_width, y + node_height)
+        x += column_width + COLUMN_GAP
+    width = x - COLUMN_GAP // 2
+    height = ROW_GAP + max(len(i) for i in columns.values()) * (node_height + ROW_GAP)
+    if width > MAX_CANVAS_WIDTH or height > MAX_CANVAS_HEIGHT or width * height > MAX_CANVAS_PIXELS:
+        raise ItemMapTooLarge("Your item map is too big to be drawn right now.")
+    canvas = _Canvas(width, height)
+
+    # Draw the edges, then the nodes over the top of them
+    for source, target, label in item_map.edges:
+        sx0, sy0, sx1, sy1 = positions[source]
+        tx0, ty0, tx1, ty1 = positions[target]
+        start = (sx1, (sy0 + sy1) // 2)
+        end = (tx0, (ty0 + ty1) // 2) if tx0 >= sx1 else (tx1, (ty0 + ty1) // 2)
+        canvas.line(*start, *end, BLACK)
+        arrow_direction = 1 if end[0] >= start[0] else -1
+        canvas.line(end[0], end[1], end[0] - 8 * arrow_direction, end[1] - 5, BLACK)
+        canvas.line(end[0], end[1], end[0] - 8 * arrow_direction, end[1] + 5, BLACK)
+        label_x = (start[0] + end[0]) // 2 - (len(label) * CHAR_WIDTH) // 2
+        label_y = (start[1] + end[1]) // 2 - CHAR_HEIGHT - 2
+        canvas.text(label_x, label_y, label)
+    for node, (x0, y0, x1, y1) in positions.items():
+        canvas.rectangle(x0, y0, x1, y1, LIGHT_BLUE if node == COMMAND_NODE else GREY)
+        canvas.text(x0 + NODE_PADDING, y0 + NODE_PADDING, labels[node])
+    return canvas.to_png()
@@ -0,0 +1,31 @@
+from cogs.utils.item_database import ItemDatabase
+from cogs.utils.metrics import MetricsRegistry, Counter, Gauge, Histogram
+
+
+class ItemMetrics(MetricsRegistry):
+    """
+    The metrics collected by the item cog.
+    """
+
+    def __init__(self, database:ItemDatabase=None):
+        super().__init__()
+        self.command_seconds = self.add(Histogram(
+            "itembot_command_seconds", "Time taken to run each command, split by where the time went",
+            ("command", "phase"),
+        ))
+        self.items_granted = self.add(Counter("itembot_items_granted_total", "Items given to users", ("source",)))
+        self.items_crafted = self.add(Counter("itembot_items_crafted_total", "Items created by crafting"))
+        self.cooldown_hits = self.add(Counter("itembot_cooldown_hits_total", "Times a user was stopped by a cooldown", ("source",)))
+        if database is not None:
+            for name, documentation in [
+                    ("in_use", "Database connections currently held by the cog"),
+                    ("acquire_count", "Database connections acquired by the cog"),
+                    ("acquire_timeouts", "Times the cog timed out waiting for a database connection"),
+                    ("acquire_wait_time_average", "Average time spent waiting for a database connection"),
+                    ("acquire_wait_time_max", "Longest time spent waiting for a database connection"),
+                    ("leaks_detected", "Database connections held for longer than the leak threshold"),
+                    ("query_count", "Queries run by the cog"),
+                    ("query_timeouts", "Queries that were cancelled for taking too long"),
+                    ("pool_size", "Connections in the database pool"),
+                    ("pool_idle", "Idle connections in the database pool")]:
+                self.add(Gauge(f"itembot_database_{name}", documentation, lambda name=name: database.get_metrics()[name]))
@@ -0,0 +1,61 @@
+import typing
+
+
+SHOP_EMOJI = "\N{SHOPPING TROLLEY}"
+
+
+class ShopOffer(object):
+    """
+    A shop message - reacting to it swaps `required_item_amount` of `item_required` for `amount_gained` of `item_name`.
+    """
+
+    __slots__ = ('guild_id', 'message_id', 'item_name', 'amount_gained', 'item_required', 'required_item_amount',)
+
+    def __init__(self, guild_id:int, message_id:int, item_name:str, amount_gained:int, item_required:str, required_item_amount:int):
+        self.guild_id = guild_id
+        self.message_id = message_id
+        self.item_name = item_name
+        self.amount_gained = amount_gained
+        self.item_required = item_required
+        self.required_item_amount = required_item_amount
+
+    @classmethod
+    def from_row(cls, row:dict) -> 'ShopOffer':
+        return cls(
+            row['guild_id'], row['message_id'], row['item_name'], row['amount_gained'],
+            row['item_required'], row['required_item_amount'],
+        )
+
+
+class ShopIndex(object):
+    """
+    Every shop message the bot knows about, keyed by message ID, so that reactions on any other
+    message can be ignored without going to the database.
+    """
+
+    def __init__(self):
+        self._offers: typing.Dict[int, ShopOffer] = {}
+
+    def __len__(self):
+        return len(self._offers)
+
+    def __contains__(self, message_id:int):
+        return message_id in self._offers
+
+    def get(self, message_id:int) -> typing.Optional[ShopOffer]:
+        return self._offers.get(message_id)
+
+    def add(self, offer:ShopOffer) -> None:
+        self._offers[offer.message_id] = offer
+
+    def remove(self, message_id:int) -> typing.Optional[ShopOffer]:
+        return self._offers.pop(message_id, None)
+
+    def load(self, rows:typing.List[dict]) -> None:
+        """
+        Replaces the index with the given shop message rows.
+        """
+
+        self._offers = {}
+        for row in rows:
+            self.add(ShopOffer.from_row(row))
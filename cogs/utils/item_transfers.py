@@ -0,0 +1,124 @@
+import collections
+import typing
+
+from cogs.utils.item_database import ItemDatabaseConnection
+
+
+InventoryKey = typing.Tuple[int, str]  # user_id, item_name
+
+
+class _NotEnoughItems(Exception):
+    """
+    Raised inside a transfer's transaction to roll it back when someone doesn't have enough of an item.
+    """
+
+
+def get_transfer_changes(
+        from_user_id:int, to_user_id:int, items:typing.Dict[str, int]) -> typing.Dict[InventoryKey, int]:
+    """
+    Gets the inventory changes for moving items from one user to another.
+    """
+
+    changes = collections.defaultdict(int)
+    for item_name, amount in items.items():
+        changes[(from_user_id, item_name)] -= amount
+        changes[(to_user_id, item_name)] += amount
+    return dict(changes)
+
+
+async def apply_inventory_changes(db:ItemDatabaseConnection, guild_id:int, changes:typing.Dict[InventoryKey, int]) -> bool:
+    """
+    Adds the given amounts (which can be negative) to any number of inventory rows in one transaction. Every
+    row is locked in (user_id, item_name) order before anything is changed, so concurrent transfers between
+    the same users wait for each other rather than deadlocking. If any row would go below zero then nothing
+    is changed and False is returned.
+    """
+
+    changes = {i: o for i, o in sorted(changes.items()) if o}
+    if not changes:
+        return True
+    user_ids = [i[0] for i in changes]
+    item_names = [i[1] for i in changes]
+    amounts = list(changes.values())
+
+    try:
+        async with db.transaction():
+
+            # Make sure there's a row for everything that's being added to, then lock them all in order
+            await db(
+                """INSERT INTO user_inventories (guild_id, user_id, item_name, amount)
+                SELECT $1, user_id, item_name, 0 FROM unnest($2::BIGINT[], $3::TEXT[]) AS c(user_id, item_name)
+                ORDER BY user_id, item_name
+                ON CONFLICT (guild_id, user_id, item_name) DO NOTHING""",
+                guild_id, [i for i, o in zip(user_ids, amounts) if o > 0], [i for i, o in zip(item_names, amounts) if o > 0],
+            )
+            locked_rows = await db(
+                """SELECT user_id, item_name, amount FROM user_inventories
+                WHERE guild_id=$1 AND (user_id, item_name) IN (SELECT * FROM unnest($2::BIGINT[], $3::TEXT[]))
+                ORDER BY user_id, item_name FOR UPDATE""",
+                guild_id, user_ids, item_names,
+            )
+
+            # See if everyone has enough
+            current = {(i['user_id'], i['item_name']): i['amount'] for i in locked_rows}
+            if any(current.get(key, 0) + amount < 0 for key, amount in changes.items()):
+                raise _NotEnoughItems()
+
+            # Change them all at once
+            await db(
+                """UPDATE user_inventories SET amount=user_inventories.amount+c.amount
+                FROM unnest($2::BIGINT[], $3::TEXT[], $4::INTEGER[]) AS c(user_id, item_name, amount)
+                WHERE user_inventories.guild_id=$1 AND user_inventories.user_id=c.user_id
+                AND user_inventories.item_name=c.item_name""",
+                guild_id, user_ids, item_names, amounts,
+            )
+    except _NotEnoughItems:
+        return False
+    return True
+
+
+async def give_items_to_users(db:ItemDatabaseConnection, guild_id:int, user_ids:typing.List[int], item_name:str, amount:int) -> None:
+    """
+    Gives every one of the given users an amount of an item as a single statement. Rows are written in
+    user ID order so that overlapping payouts lock them in the same order.
+    """
+
+    await db(
+        """INSERT INTO user_inventories (guild_id, user_id, item_name, amount)
+        SELECT $1, user_id, $3, $4 FROM unnest($2::BIGINT[]) AS u(user_id)
+        ORDER BY user_id
+        ON CONFLICT (guild_id, user_id, item_name)
+        DO UPDATE SET amount=user_inventories.amount+excluded.amount""",
+        guild_id, sorted(set(user_ids)), item_name, amount,
+    )
+
+
+async def exchange_items(
+        db:ItemDatabaseConnection, guild_id:int, user_id:int, removed_item:str, removed_amount:int,
+        added_item:str, added_amount:int) -> bool:
+    """
+    Swaps an amount of one item in a user's inventory for an amount of another as a single statement, but only
+    if they have enough of the item being taken. Both rows are locked in item name order first, the same as
+    :func:`apply_inventory_changes`. Returns whether the exchange happened.
+    """
+
+    rows = await db(
+        """WITH locked AS (
+            SELECT item_name, amount FROM user_inventories
+            WHERE guild_id=$1 AND user_id=$2 AND item_name IN ($3, $5)
+            ORDER BY item_name FOR UPDATE
+        ), removed AS (
+            UPDATE user_inventories SET amount=user_inventories.amount-$4
+            FROM locked
+            WHERE user_inventories.guild_id=$1 AND user_inventories.user_id=$2 AND user_inventories.item_name=$3
+            AND locked.item_name=$3 AND locked.amount >= $4
+            RETURNING user_inventories.item_name
+        )
+        INSERT INTO user_inventories (guild_id, user_id, item_name, amount)
+        SELECT $1, $2, $5, $6 WHERE EXISTS (SELECT 1 FROM removed)
+        ON CONFLICT (guild_id, user_id, item_name)
+        DO UPDATE SET amount=user_inventories.amount+excluded.amount
+        RETURNING amount""",
+        guild_id, user_id, removed_item, removed_amount, added_item, added_amount,
+    )
+    return bool(rows)
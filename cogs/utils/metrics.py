@@ -0,0 +1,274 @@
+import asyncio
+import bisect
+import collections
+import contextlib
+import contextvars
+import logging
+import os
+import time
+import typing
+
+from aiohttp import web
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labelnames:typing.Tuple[str, ...], labelvalues:typing.Tuple[str, ...], **extra) -> str:
+    pairs = list(zip(labelnames, labelvalues)) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{i}="{str(o)}"'.replace('\n', ' ') for i, o in pairs) + '}'
+
+
+class Counter(object):
+    """
+    A number that only goes up.
+    """
+
+    type_name = "counter"
+
+    def __init__(self, name:str, documentation:str, labelnames:typing.Tuple[str, ...]=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: typing.Dict[typing.Tuple[str, ...], float] = collections.defaultdict(float)
+
+    def inc(self, amount:float=1, **labels) -> None:
+        self._values[tuple(str(labels[i]) for i in self.labelnames)] += amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(tuple(str(labels[i]) for i in self.labelnames), 0)
+
+    def render(self) -> typing.List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, i)} {o}" for i, o in self._values.items()]
+
+
+class Gauge(object):
+    """
+    A number that's read from a function whenever the metrics are collected.
+    """
+
+    type_name = "gauge"
+
+    def __init__(self, name:str, documentation:str, function:typing.Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def render(self) -> typing.List[str]:
+        value = self.function()
+        if value is None:
+            return []
+        return [f"{self.name} {value}"]
+
+
+class Histogram(object):
+    """
+    Counts observed values into buckets, along with their sum and count.
+    """
+
+    type_name = "histogram"
+
+    def __init__(self, name:str, documentation:str, labelnames:typing.Tuple[str, ...]=(), buckets:typing.Tuple[float, ...]=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._counts: typing.Dict[typing.Tuple[str, ...], typing.List[int]] = {}
+        self._sums: typing.Dict[typing.Tuple[str, ...], float] = collections.defaultdict(float)
+
+    def observe(self, value:float, **labels) -> None:
+        key = tuple(str(labels[i]) for i in self.labelnames)
+        counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[key] += value
+
+    def render(self) -> typing.List[str]:
+        lines = []
+        for key, counts in self._counts.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le=le)} {total}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {self._sums[key]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {total}")
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    A collection of metrics that can be rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.metrics: typing.List[typing.Union[Counter, Gauge, Histogram]] = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+    def write_to_file(self, path:str) -> None:
+        """
+        Writes the rendered metrics to a file, replacing it atomically.
+        """
+
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as a:
+            a.write(self.render())
+        os.replace(temp_path, path)
+
+
+class CommandTimer(object):
+    """
+    Adds up where the time went while running a single command. The timer can be paused so that time
+    spent waiting on the user isn't counted - pauses can overlap, and it only starts again once they've
+    all finished. Phase time isn't added while it's paused either, so the phases never add up to more
+    than the total.
+    """
+
+    __slots__ = ('start_time', 'phases', 'paused_seconds', '_paused_at', '_pauses',)
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.phases: typing.Dict[str, float] = collections.defaultdict(float)
+        self.paused_seconds = 0.0
+        self._paused_at: float = None
+        self._pauses = 0
+
+    def add(self, phase:str, seconds:float) -> None:
+        if self._pauses:
+            return
+        self.phases[phase] += seconds
+
+    def pause(self) -> None:
+        if self._pauses == 0:
+            self._paused_at = time.perf_counter()
+        self._pauses += 1
+
+    def resume(self) -> None:
+        self._pauses -= 1
+        if self._pauses == 0:
+            self.paused_seconds += time.perf_counter() - self._paused_at
+            self._paused_at = None
+
+    @property
+    def elapsed(self) -> float:
+        now = time.perf_counter()
+        paused_seconds = self.paused_seconds
+        if self._paused_at is not None:
+            paused_seconds += now - self._paused_at
+        return now - self.start_time - paused_seconds
+
+
+current_command_timer: contextvars.ContextVar = contextvars.ContextVar('current_command_timer', default=None)
+
+
+def record_phase(phase:str, seconds:float) -> None:
+    """
+    Adds time to the command that's currently running, if there is one.
+    """
+
+    timer = current_command_timer.get()
+    if timer is not None:
+        timer.add(phase, seconds)
+
+
+@contextlib.contextmanager
+def timed(phase:str):
+    """
+    Adds the time spent in the block to the given phase of the command that's currently running.
+    """
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_phase(phase, time.perf_counter() - start_time)
+
+
+@contextlib.contextmanager
+def untimed():
+    """
+    Leaves the time spent in the block out of the command that's currently running, eg while it's waiting
+    for the user to answer.
+    """
+
+    timer = current_command_timer.get()
+    if timer is not None:
+        timer.pause()
+    try:
+        yield
+    finally:
+        if timer is not None:
+            timer.resume()
+
+
+def timed_coroutine_function(phase:str, function:typing.Callable[..., typing.Awaitable]) -> typing.Callable[..., typing.Awaitable]:
+    """
+    Wraps a coroutine function so the time spent awaiting it is added to the given phase.
+    """
+
+    async def wrapper(*args, **kwargs):
+        with timed(phase):
+            return await function(*args, **kwargs)
+    return wrapper
+
+
+class MetricsExporter(object):
+    """
+    Serves a metrics registry over HTTP at `/metrics`, and/or writes it to a file on an interval.
+    """
+
+    def __init__(
+            self, registry:MetricsRegistry, *, host:str='127.0.0.1', port:int=None, file:str=None,
+            file_interval:float=60.0, logger:logging.Logger=None):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.file = file
+        self.file_interval = file_interval
+        self.logger = logger or logging.getLogger("bot.metrics")
+        self._runner: web.AppRunner = None
+        self._file_task: asyncio.Task = None
+
+    async def handle_metrics(self, request:web.Request) -> web.Response:
+        return web.Response(text=self.registry.render(), content_type='text/plain', charset='utf-8')
+
+    async def _file_loop(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                await loop.run_in_executor(None, self.registry.write_to_file, self.file)
+            except Exception as e:
+                self.logger.error(f"Failed to write metrics to {self.file} - {e}")
+            await asyncio.sleep(self.file_interval)
+
+    async def start(self) -> None:
+        if self.port:
+            app = web.Application()
+            app.router.add_get('/metrics', self.handle_metrics)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, self.host, self.port).start()
+            self.logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+        if self.file:
+            self._file_task = asyncio.ensure_future(self._file_loop())
+
+    async def stop(self) -> None:
+        if self._file_task is not None:
+            self._file_task.cancel()
+            self._file_task = None
+            self.registry.write_to_file(self.file)
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,118 @@
+import collections
+import time
+import typing
+
+import voxelbotutils as utils
+from discord.ext import commands
+
+
+RateLimit = typing.Tuple[int, float]  # uses, seconds
+BucketKey = typing.Tuple[str, str, int]  # command name, scope, user or guild ID
+
+DEFAULT_COMMAND_RATE_LIMITS: typing.Dict[str, typing.Dict[str, RateLimit]] = {
+    "itemmap": {"user": (2, 60.0), "guild": (6, 60.0)},
+    "craftitem": {"user": (4, 20.0), "guild": (30, 20.0)},
+    "craftall": {"user": (3, 30.0), "guild": (20, 30.0)},
+    "acquireitem": {"user": (3, 60.0), "guild": (6, 60.0)},
+    "trade": {"user": (4, 30.0), "guild": (30, 30.0)},
+    "exportitems": {"user": (2, 300.0), "guild": (2, 300.0)},
+    "importitems": {"user": (2, 300.0), "guild": (2, 300.0)},
+}
+
+
+class CommandRateLimited(commands.CheckFailure):
+    """
+    Raised when a user or guild has run out of uses for a rate limited command.
+    """
+
+    def __init__(self, scope:str, retry_after:float):
+        self.scope = scope
+        self.retry_after = retry_after
+        wait = utils.TimeValue(max(int(retry_after + 0.999), 1)).clean_spaced
+        if scope == "guild":
+            message = f"This command is being used too much in this server - please try again in `{wait}`."
+        else:
+            message = f"You're using this command too quickly - please try again in `{wait}`."
+        super().__init__(message)
+
+
+class TokenBucket(object):
+
+    __slots__ = ('tokens', 'updated',)
+
+    def __init__(self, tokens:float, updated:float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class CommandRateLimiter(object):
+    """
+    Token bucket rate limits for commands, kept in memory so they can be checked before any other work is
+    done. Each limited command has a bucket per user and/or per guild that holds up to `uses` tokens and
+    refills over `seconds`, so short bursts are let through but sustained use is held to the given rate.
+    A command is only let through if every bucket it uses has a token spare.
+
+    Buckets are dropped least recently used first once there are more than `max_size` of them. A dropped
+    bucket comes back full, which only matters for buckets that haven't been used in a while anyway.
+    """
+
+    def __init__(self, limits:typing.Dict[str, typing.Dict[str, RateLimit]], *, max_size:int=100_000):
+        self.limits = limits
+        self.max_size = max_size
+        self._buckets: typing.Dict[BucketKey, TokenBucket] = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _get_bucket(self, key:BucketKey, limit:RateLimit, now:float) -> TokenBucket:
+        uses, seconds = limit
+        bucket = self._buckets.pop(key, None)
+        if bucket is None:
+            bucket = TokenBucket(uses, now)
+        else:
+            bucket.tokens = min(uses, bucket.tokens + (now - bucket.updated) * uses / seconds)
+            bucket.updated = now
+        self._buckets[key] = bucket
+        return bucket
+
+    def try_acquire(self, command_name:str, guild_id:typing.Optional[int], user_id:int) -> None:
+        """
+        Takes a token for a command from the user's and guild's buckets.
+
+        Raises:
+            CommandRateLimited: If either bucket is empty. Neither bucket is touched.
+        """
+
+        command_limits = self.limits.get(command_name)
+        if not command_limits:
+            return
+        now = time.monotonic()
+        buckets = []
+        for scope, object_id in (("user", user_id), ("guild", guild_id)):
+            limit = command_limits.get(scope)
+            if limit is None or object_id is None:
+                continue
+            bucket = self._get_bucket((command_name, scope, object_id), limit, now)
+            if bucket.tokens < 1:
+                uses, seconds = limit
+                raise CommandRateLimited(scope, (1 - bucket.tokens) * seconds / uses)
+            buckets.append(bucket)
+        for bucket in buckets:
+            bucket.tokens -= 1
+        while len(self._buckets) > self.max_size:
+            self._buckets.popitem(last=False)
+
+
+def get_command_rate_limiter(bot:utils.Bot) -> CommandRateLimiter:
+    """
+    Gets the command rate limiter set up in the bot's config.
+    """
+
+    config = bot.config.get('rate_limits', {})
+    limits = DEFAULT_COMMAND_RATE_LIMITS
+    if 'commands' in config:
+        limits = {
+            command_name: {scope: (int(limit[0]), float(limit[1])) for scope, limit in command_limits.items()}
+            for command_name, command_limits in config['commands'].items()
+        }
+    return CommandRateLimiter(limits, max_size=config.get('max_size', 100_000))
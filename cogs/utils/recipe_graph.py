@@ -0,0 +1,143 @@
+import collections
+import typing
+
+
+class CraftingPlan(object):
+    """
+    A set of crafts that gets a user from their current inventory to a target item.
+
+    Attributes:
+        steps (typing.List[typing.Tuple[str, int]]): The items to craft and how many times to craft each of them,
+            in the order that they need to be crafted.
+        missing (typing.Dict[str, int]): The uncraftable items that the user doesn't have enough of to carry out the plan.
+        removed (typing.Dict[str, int]): The net amount of each item taken from the user's inventory.
+        added (typing.Dict[str, int]): The net amount of each item added to the user's inventory.
+    """
+
+    def __init__(self, steps, missing, removed, added):
+        self.steps: typing.List[typing.Tuple[str, int]] = steps
+        self.missing: typing.Dict[str, int] = missing
+        self.removed: typing.Dict[str, int] = removed
+        self.added: typing.Dict[str, int] = added
+
+    @property
+    def possible(self) -> bool:
+        return not self.missing
+
+
+class RecipeGraph(object):
+    """
+    The crafting recipes for a guild as a graph, where each ingredient points to the items that it's
+    used to craft. The topological order is worked out when the graph is made; items that are part of
+    (or made from) a cycle are left out of it and can't be planned through.
+    """
+
+    def __init__(self, craftable_items:typing.Dict[str, int], recipes:typing.Dict[str, typing.Dict[str, int]]):
+        self.craftable_items = craftable_items  # item_name: amount_created
+        self.recipes = recipes  # item_name: {ingredient_name: amount}
+
+        # Get the order to craft things in, ingredients first
+        used_in = collections.defaultdict(list)
+        unmet_ingredients = {}
+        nodes = set(recipes)
+        for item_name, ingredients in recipes.items():
+            unmet_ingredients[item_name] = len(ingredients)
+            for ingredient_name in ingredients:
+                used_in[ingredient_name].append(item_name)
+                nodes.add(ingredient_name)
+        queue = collections.deque(sorted(i for i in nodes if not unmet_ingredients.get(i)))
+        order = []
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for item_name in used_in[node]:
+                unmet_ingredients[item_name] -= 1
+                if unmet_ingredients[item_name] == 0:
+                    queue.append(item_name)
+        self.topological_order: typing.List[str] = order
+        self.cyclic_items: typing.Set[str] = nodes.difference(order)
+
+    def with_recipe(self, item_name:str, amount_created:int, ingredients:typing.Dict[str, int]) -> 'RecipeGraph':
+        """
+        Gets a copy of the graph with a recipe added or replaced.
+        """
+
+        craftable_items = self.craftable_items.copy()
+        craftable_items[item_name] = amount_created
+        recipes = self.recipes.copy()
+        recipes[item_name] = ingredients
+        return self.__class__(craftable_items, recipes)
+
+    def find_cycle(self) -> typing.Optional[typing.List[str]]:
+        """
+        Finds a cycle in the recipes, if there is one.
+
+        Returns:
+            typing.Optional[typing.List[str]]: The items in the cycle with the first item repeated at the end,
+                or None if there's no cycle.
+        """
+
+        if not self.cyclic_items:
+            return None
+        visiting, visited = [], set()
+
+        def visit(item_name):
+            if item_name in visiting:
+                return visiting[visiting.index(item_name):] + [item_name]
+            if item_name in visited:
+                return None
+            visiting.append(item_name)
+            for ingredient_name in sorted(self.recipes.get(item_name, {})):
+                if ingredient_name in self.cyclic_items:
+                    cycle = visit(ingredient_name)
+                    if cycle:
+                        return cycle
+            visiting.pop()
+            visited.add(item_name)
+            return None
+
+        for item_name in sorted(self.cyclic_items):
+            cycle = visit(item_name)
+            if cycle:
+                return cycle[::-1]
+        return None
+
+    def plan(self, item_name:str, craft_count:int, inventory:typing.Dict[str, int]) -> CraftingPlan:
+        """
+        Plans the fewest crafts needed to craft an item a given number of times, using what's in the user's
+        inventory first and crafting any intermediate items that they're short on.
+        """
+
+        if item_name not in self.craftable_items or item_name in self.cyclic_items:
+            raise KeyError(item_name)
+
+        # Walk from the target item down to the base ingredients, so each item's total demand
+        # is known before we work out how many times to craft it
+        crafts = {item_name: craft_count}
+        demand = collections.defaultdict(int)
+        missing = {}
+        for node in reversed(self.topological_order):
+            if node != item_name:
+                shortfall = demand[node] - inventory.get(node, 0)
+                if shortfall <= 0:
+                    continue
+                if node not in self.craftable_items:
+                    missing[node] = shortfall
+                    continue
+                amount_created = self.craftable_items[node]
+                crafts[node] = -(-shortfall // amount_created)
+            elif node not in crafts:
+                continue
+            for ingredient_name, amount in self.recipes.get(node, {}).items():
+                demand[ingredient_name] += amount * crafts[node]
+
+        # Work out the net change to their inventory
+        removed, added = {}, {}
+        for node in set(crafts).union(demand):
+            change = crafts.get(node, 0) * self.craftable_items.get(node, 0) - demand.get(node, 0)
+            if change < 0:
+                removed[node] = -change
+            elif change > 0:
+                added[node] = change
+        steps = [(i, crafts[i]) for i in self.topological_order if i in crafts]
+        return CraftingPlan(steps, missing, removed, added)
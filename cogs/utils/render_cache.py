@@ -0,0 +1,197 @@
+import asyncio
+import collections
+import hashlib
+import os
+import time
+import typing
+
+
+class RenderCache(object):
+    """
+    A cache of rendered images keyed by a hash of the source they were rendered from. Images are kept
+    in a size-bounded memory tier and, if a directory is given, written to disk as well. Concurrent
+    requests for the same source share one render.
+
+    The disk tier is pruned in the background - files that haven't been used for `disk_max_age` seconds
+    are deleted, then the least recently used ones until there's less than `disk_max_bytes` left. This also
+    cleans up files left behind from before a restart, which nothing else knows about.
+    """
+
+    def __init__(
+            self, *, max_bytes:int=32 * 1024 * 1024, directory:str=None, disk_max_bytes:int=256 * 1024 * 1024,
+            disk_max_age:float=7 * 24 * 60 * 60, prune_interval:float=60 * 60):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_max_age = disk_max_age
+        self.prune_interval = prune_interval
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._memory: typing.Dict[str, bytes] = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = 0  # Roughly how much is on disk - exact after each prune, then added to as files are written
+        self._last_prune = 0.0
+        self._pruning: asyncio.Future = None
+        self._rendering: typing.Dict[str, asyncio.Future] = {}
+        self._guild_keys: typing.Dict[int, typing.Set[str]] = collections.defaultdict(set)
+        self._key_guilds: typing.Dict[str, typing.Set[int]] = collections.defaultdict(set)
+
+    @staticmethod
+    def get_key(source:str) -> str:
+        return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+    def _get_path(self, key:str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+
+    def _read_disk(self, key:str) -> typing.Optional[bytes]:
+        try:
+            with open(self._get_path(key), 'rb') as a:
+                data = a.read()
+            os.utime(self._get_path(key))  # So that pruning sees it as recently used
+            return data
+        except FileNotFoundError:
+            return None
+
+    def _write_disk(self, key:str, data:bytes) -> None:
+        temp_path = self._get_path(key) + f".{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as a:
+            a.write(data)
+        os.replace(temp_path, self._get_path(key))
+
+    def _delete_disk(self, keys:typing.Iterable[str]) -> None:
+        for key in keys:
+            try:
+                os.remove(self._get_path(key))
+            except FileNotFoundError:
+                pass
+
+    def _prune_disk(self) -> int:
+        """
+        Deletes files from the disk tier that are too old, then the oldest ones until it's under its size limit.
+
+        Returns:
+            int: The number of bytes left on disk.
+        """
+
+        files = []
+        now = time.time()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.endswith(('.png', '.tmp')):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+        total_bytes = sum(i[1] for i in files)
+        for modified, size, path in files:
+            if now - modified <= self.disk_max_age and total_bytes <= self.disk_max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+        return total_bytes
+
+    def _maybe_prune_disk(self) -> None:
+        """
+        Starts pruning the disk tier in a thread if it's due and isn't running already.
+        """
+
+        if not self.directory or (self._pruning is not None and not self._pruning.done()):
+            return
+        due = time.monotonic() - self._last_prune > self.prune_interval
+        if not due and self._disk_bytes <= self.disk_max_bytes:
+            return
+        self._last_prune = time.monotonic()
+        self._pruning = asyncio.get_event_loop().run_in_executor(None, self._prune_disk)
+        self._pruning.add_done_callback(self._store_pruned_size)
+
+    def _store_pruned_size(self, future:asyncio.Future) -> None:
+        if not future.cancelled() and future.exception() is None:
+            self._disk_bytes = future.result()
+
+    def _store_memory(self, key:str, data:bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return
+        self._memory[key] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_bytes:
+            evicted_key, evicted_data = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted_data)
+            self._forget_key(evicted_key)
+
+    def _remember_key(self, guild_id:int, key:str) -> None:
+        self._guild_keys[guild_id].add(key)
+        self._key_guilds[key].add(guild_id)
+
+    def _forget_key(self, key:str) -> None:
+        for guild_id in self._key_guilds.pop(key, set()):
+            self._guild_keys[guild_id].discard(key)
+            if not self._guild_keys[guild_id]:
+                del self._guild_keys[guild_id]
+
+    async def get_or_render(self, guild_id:int, source:str, render:typing.Callable[[], typing.Awaitable[bytes]]) -> bytes:
+        """
+        Gets the image for the given source from the cache, or renders and caches it if it's not there.
+        """
+
+        key = self.get_key(source)
+
+        # See if it's in memory
+        try:
+            data = self._memory[key]
+            self._memory.move_to_end(key)
+            self._remember_key(guild_id, key)
+            return data
+        except KeyError:
+            pass
+
+        # See if someone's rendering it already
+        future = self._rendering.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._load(key, render))
+            self._rendering[key] = future
+            future.add_done_callback(lambda f: self._rendering.pop(key, None))
+        data = await asyncio.shield(future)
+
+        # Keys are only tracked while they're in memory - it won't be if it was too big to keep, or the render failed
+        if key in self._memory:
+            self._remember_key(guild_id, key)
+        return data
+
+    async def _load(self, key:str, render:typing.Callable[[], typing.Awaitable[bytes]]) -> bytes:
+        loop = asyncio.get_event_loop()
+        data = None
+        if self.directory:
+            data = await loop.run_in_executor(None, self._read_disk, key)
+        if data is None:
+            data = await render()
+            if self.directory:
+                await loop.run_in_executor(None, self._write_disk, key, data)
+                self._disk_bytes += len(data)
+        self._store_memory(key, data)
+        self._maybe_prune_disk()
+        return data
+
+    def invalidate_guild(self, guild_id:int) -> None:
+        """
+        Drops every image that was rendered for a guild and is still in memory, deleting their files on disk in a thread.
+        Anything that's already left memory is keyed by the source it was rendered from, so it can't be served
+        for the guild's changed items anyway - it's left on disk for pruning to clean up.
+        """
+
+        keys = self._guild_keys.pop(guild_id, set())
+        for key in keys:
+            data = self._memory.pop(key, None)
+            if data is not None:
+                self._memory_bytes -= len(data)
+            self._forget_key(key)
+        if self.directory and keys:
+            asyncio.get_event_loop().run_in_executor(None, self._delete_disk, keys)
@@ -0,0 +1,135 @@
+import asyncio
+import collections
+import datetime as dt
+import json
+import typing
+
+from cogs.utils.item_database import ItemDatabase
+
+
+SessionKey = typing.Tuple[int, int]  # channel_id, user_id
+
+
+class SetupSession(object):
+    """
+    Where a user is in one of the item setup flows. `state` names the step that's waiting for their answer,
+    and `data` holds everything they've answered so far.
+    """
+
+    __slots__ = ('channel_id', 'user_id', 'guild_id', 'item_name', 'state', 'data', 'prompt_message_id', 'expires_at',)
+
+    def __init__(
+            self, channel_id:int, user_id:int, guild_id:int, item_name:str, state:str, data:dict=None,
+            prompt_message_id:int=None, expires_at:dt.datetime=None):
+        self.channel_id = channel_id
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.item_name = item_name
+        self.state = state
+        self.data = data or {}
+        self.prompt_message_id = prompt_message_id
+        self.expires_at = expires_at
+
+    @property
+    def key(self) -> SessionKey:
+        return (self.channel_id, self.user_id)
+
+    @classmethod
+    def from_row(cls, row:dict) -> 'SetupSession':
+        data = row['data']
+        return cls(
+            row['channel_id'], row['user_id'], row['guild_id'], row['item_name'], row['state'],
+            json.loads(data) if isinstance(data, str) else data, row['prompt_message_id'], row['expires_at'],
+        )
+
+
+class SetupSessionStore(object):
+    """
+    The setup sessions that are waiting on a user, keyed by channel and user so that an incoming message or
+    reaction is matched with a single dict lookup. Sessions are kept in memory and written to the
+    `item_setup_sessions` table whenever they move on, so they can be picked back up after a restart.
+    """
+
+    def __init__(self, database:ItemDatabase, *, timeout:float=120.0):
+        self.database = database
+        self.timeout = timeout
+        self._sessions: typing.Dict[SessionKey, SetupSession] = {}
+        self._locks: typing.Dict[SessionKey, asyncio.Lock] = collections.defaultdict(asyncio.Lock)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, channel_id:int, user_id:int) -> typing.Optional[SetupSession]:
+        """
+        Gets the running session for a user in a channel, if there is one that hasn't expired.
+        """
+
+        session = self._sessions.get((channel_id, user_id))
+        if session is None or session.expires_at <= dt.datetime.utcnow():
+            return None
+        return session
+
+    def lock(self, key:SessionKey) -> asyncio.Lock:
+        """
+        Gets the lock for a session, so that two quick answers can't both be handled for the same step.
+        """
+
+        return self._locks[key]
+
+    async def save(self, session:SetupSession) -> None:
+        """
+        Stores a session as it is now, giving the user another full timeout to answer.
+        """
+
+        session.expires_at = dt.datetime.utcnow() + dt.timedelta(seconds=self.timeout)
+        self._sessions[session.key] = session
+        async with self.database() as db:
+            await db(
+                """INSERT INTO item_setup_sessions (channel_id, user_id, guild_id, item_name, state, data, prompt_message_id, expires_at)
+                VALUES ($1, $2, $3, $4, $5, $6::JSONB, $7, $8) ON CONFLICT (channel_id, user_id) DO UPDATE SET
+                guild_id=excluded.guild_id, item_name=excluded.item_name, state=excluded.state, data=excluded.data,
+                prompt_message_id=excluded.prompt_message_id, expires_at=excluded.expires_at""",
+                session.channel_id, session.user_id, session.guild_id, session.item_name, session.state,
+                json.dumps(session.data), session.prompt_message_id, session.expires_at,
+            )
+
+    async def end(self, session:SetupSession) -> None:
+        """
+        Removes a finished session.
+        """
+
+        if self._sessions.get(session.key) is session:
+            del self._sessions[session.key]
+            self._locks.pop(session.key, None)
+        async with self.database() as db:
+            await db("DELETE FROM item_setup_sessions WHERE channel_id=$1 AND user_id=$2", session.channel_id, session.user_id)
+
+    def load(self, rows:typing.List[dict]) -> None:
+        """
+        Replaces the stored sessions with the given rows from the database.
+        """
+
+        self._sessions = {}
+        for row in rows:
+            session = SetupSession.from_row(row)
+            self._sessions[session.key] = session
+
+    async def pop_expired(self) -> typing.List[SetupSession]:
+        """
+        Removes and returns every session that's run out of time.
+        """
+
+        now = dt.datetime.utcnow()
+        expired = [i for i in self._sessions.values() if i.expires_at <= now]
+        if not expired:
+            return []
+        for session in expired:
+            del self._sessions[session.key]
+            self._locks.pop(session.key, None)
+        async with self.database() as db:
+            await db(
+                """DELETE FROM item_setup_sessions WHERE (channel_id, user_id) IN (SELECT * FROM unnest($1::BIGINT[], $2::BIGINT[]))
+                AND expires_at <= $3""",
+                [i.channel_id for i in expired], [i.user_id for i in expired], now,
+            )
+        return expired
@@ -0,0 +1,73 @@
+"""
+Exports user inventories and the item event log into chunked CSV (or Parquet) files for analytics,
+without going through the bot. Rows are streamed out of the database with `COPY ... TO STDOUT`, so
+an export never holds more than one chunk in memory.
+
+Run from the repository root:
+
+    python -m scripts.export_analytics --config config/config.toml --output exports/
+    python -m scripts.export_analytics --guild-id 123456789 --since 2021-06-01 --format parquet
+
+The database is read from the `dsn` in the config's `[analytics_export]` section if it's set (eg a
+read replica), otherwise from `[database]`. Pass `--dsn` to override both.
+"""
+
+import argparse
+import asyncio
+import datetime as dt
+import logging
+import os
+
+import asyncpg
+import toml
+
+from cogs.utils.analytics_export import EXPORT_FORMATS, export_analytics, get_export_connect_kwargs
+
+
+async def run_export(args:argparse.Namespace) -> dict:
+    """
+    Connects to the database and streams everything out.
+    """
+
+    with open(args.config) as a:
+        config = toml.load(a)
+    export_config = config.get('analytics_export', {})
+    directory = args.output or os.path.join(
+        export_config.get('directory') or 'exports',
+        f"{dt.datetime.utcnow():%Y%m%d-%H%M%S}-{args.guild_id or 'all'}",
+    )
+    connect_kwargs = {'dsn': args.dsn} if args.dsn else get_export_connect_kwargs(config)
+    connection = await asyncpg.connect(**connect_kwargs)
+    try:
+        return await export_analytics(
+            connection, directory, guild_id=args.guild_id,
+            since=dt.datetime.fromisoformat(args.since) if args.since else None,
+            file_format=args.format or export_config.get('format', 'csv'),
+            chunk_size=args.chunk_size or export_config.get('chunk_size', 64 * 1024 * 1024),
+        )
+    finally:
+        await connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export inventories and item events for analytics.")
+    parser.add_argument("--config", default="config/config.toml", help="The bot config to read the database settings from.")
+    parser.add_argument("--dsn", help="The database to read from, instead of the one in the config.")
+    parser.add_argument("--output", help="The directory to write files to - defaults to a new one in the configured export directory.")
+    parser.add_argument("--guild-id", type=int, help="Only export this guild.")
+    parser.add_argument("--since", help="Only export item events from after this UTC date/time (eg 2021-06-01).")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, help="The file format to write.")
+    parser.add_argument("--chunk-size", type=int, help="Roughly how many uncompressed bytes go in each file.")
+    args = parser.parse_args()
+
+    # Export and say what we wrote
+    logging.basicConfig(level=logging.WARNING)
+    exported = asyncio.get_event_loop().run_until_complete(run_export(args))
+    for name, (row_count, paths) in exported.items():
+        print(f"{name}: {row_count:,} rows in {len(paths):,} files")
+        for path in paths:
+            print(f"    {path} ({os.path.getsize(path):,} bytes)")
+
+
+if __name__ == "__main__":
+    main()